@@ -3,22 +3,74 @@ import asyncpg
 import chromadb
 from chromadb.config import Settings
 from app.ai_conversation.db import migrate
-from app.ai_conversation.file_handling.vectorstore import set_chroma
+from app.ai_conversation.file_handling.vectorstore import (
+    SEMANTIC_BREAKPOINT_PERCENTILE,
+    SEMANTIC_MAX_TOKENS,
+    TEXT_SEPARATORS,
+    TEXT_SPLITTER,
+    set_chroma,
+)
+from app.ai_conversation.file_handling.chunk_refs import ChunkRefs, set_chunk_refs
+from app.ai_conversation.file_handling.semantic_splitter import (
+    SemanticSplitter,
+    set_semantic_splitter,
+)
+from app.ai_conversation.file_handling.reindexer import reindex_stale_content
+from app.ai_conversation.file_handling.parsing import (
+    DocumentParser,
+    get_document_parser,
+    set_document_parser,
+)
+from app.ai_conversation.file_handling.image_optimizer import (
+    ImageOptimizer,
+    get_image_optimizer,
+    set_image_optimizer,
+)
+from app.ai_conversation.file_handling.file_jobs import (
+    FileJobWorker,
+    get_file_job_worker,
+    set_file_job_worker,
+)
+from app.ai_conversation.file_handling.retrieval import set_cross_encoder
+from app.ai_conversation.file_handling.lexical_index import (
+    LexicalIndex,
+    set_lexical_index,
+)
+from app.ai_conversation.file_handling.processing_registry import (
+    ProcessingRegistry,
+    get_processing_registry,
+    set_processing_registry,
+)
+from app.ai_conversation.file_handling.ingestion import (
+    IngestionPipeline,
+    get_ingestion_pipeline,
+    set_ingestion_pipeline,
+)
 from app.ai_conversation.file_handling.file_upload_processor import (
     remove_unreferenced_content,
+    remove_stale_uploads,
     optimize_file_content,
 )
 from langchain_chroma import Chroma
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from psycopg_pool import AsyncConnectionPool
 from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
-from langchain_huggingface import HuggingFaceEmbeddings
+from app.ai_conversation.embeddings.backends import load_embedding_backend
+from app.ai_conversation.embeddings.batching import MicroBatchingEmbeddings
+from app.ai_conversation.embeddings.cache import CachedEmbeddings, DiskEmbeddingStore
+from app.ai_conversation.embeddings.executor import (
+    EmbeddingExecutor,
+    OffloadedEmbeddings,
+    get_embedding_executor,
+    set_embedding_executor,
+)
 
 
 async_connection_pool = None
 postgres_checkpointer = None
 scheduler = None
 sentence_transformer_ef = None
+embedding_model_id = None
 # "avsolatorio/GIST-all-MiniLM-L6-v2"
 # "nomic-ai/nomic-embed-text-v1.5"
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
@@ -27,6 +79,12 @@ def get_embedding_function():
     global sentence_transformer_ef
     return sentence_transformer_ef
 
+
+def get_embedding_model_id():
+    global embedding_model_id
+    return embedding_model_id
+
+
 def get_connection_pool():
     global async_connection_pool
     return async_connection_pool
@@ -85,37 +143,118 @@ async def init():
             chroma_client_auth_credentials=os.getenv("CHROMA_TOKEN", "test-token"),
         ),
     )
-    global sentence_transformer_ef
+    global sentence_transformer_ef, embedding_model_id
     model = MODEL_NAME  # sentence-transformers/all-mpnet-base-v2
-    sentence_transformer_ef = HuggingFaceEmbeddings(model_name=model)
+    embeddings, backend = load_embedding_backend(
+        model, os.getenv("EMBEDDING_BACKEND", "torch")
+    )
+    # vectors of different backends must not be mixed up in the cache
+    embedding_model_id = model if backend == "torch" else f"{model}@{backend}"
+    executor = EmbeddingExecutor(
+        max_workers=int(os.getenv("EMBEDDING_WORKERS", "1")),
+        max_queue=int(os.getenv("EMBEDDING_QUEUE_SIZE", "16")),
+    )
+    set_embedding_executor(executor)
+    disk_store = None
+    if cache_dir := os.getenv("EMBEDDING_CACHE_DIR"):
+        disk_store = DiskEmbeddingStore(
+            cache_dir,
+            embedding_model_id,
+            max_rows=int(os.getenv("EMBEDDING_CACHE_DISK_ROWS", "1000000")),
+            dimension=embeddings.client.get_sentence_embedding_dimension(),
+        )
+    batched_embeddings = MicroBatchingEmbeddings(
+        OffloadedEmbeddings(embeddings, executor),
+        max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "64")),
+        max_wait_ms=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")),
+    )
+    sentence_transformer_ef = CachedEmbeddings(
+        batched_embeddings,
+        embedding_model_id,
+        max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+        disk_store=disk_store,
+    )
     chroma = Chroma(
         client=client,
         collection_name="langchain",
         embedding_function=sentence_transformer_ef,
         collection_metadata={"hnsw:space": "cosine"},
     )
-    set_chroma(chroma)
+    set_chroma(chroma, embedding_model_id)
+    set_chunk_refs(ChunkRefs(async_connection_pool))
+    set_lexical_index(LexicalIndex(async_connection_pool))
+    if rerank_model := os.getenv("RERANK_MODEL"):
+        from sentence_transformers import CrossEncoder
+
+        set_cross_encoder(CrossEncoder(rerank_model, device="cpu"))
+    if TEXT_SPLITTER == "semantic":
+        # sentences of uploads are not worth caching
+        set_semantic_splitter(
+            SemanticSplitter(
+                batched_embeddings,
+                embeddings.client.tokenizer,
+                # minus [CLS] and [SEP]
+                min(SEMANTIC_MAX_TOKENS, embeddings.client.max_seq_length) - 2,
+                TEXT_SEPARATORS,
+                breakpoint_percentile=SEMANTIC_BREAKPOINT_PERCENTILE,
+            )
+        )
+    set_document_parser(
+        DocumentParser(
+            workers=int(os.getenv("PARSER_WORKERS", "2")),
+            timeout=float(os.getenv("PARSER_TIMEOUT", "300")),
+            memory_limit_mb=int(os.getenv("PARSER_MEMORY_LIMIT_MB", "0")),
+        )
+    )
+    set_image_optimizer(
+        ImageOptimizer(
+            workers=int(os.getenv("IMAGE_WORKERS", "1")),
+            timeout=float(os.getenv("IMAGE_TIMEOUT", "300")),
+            memory_limit_mb=int(os.getenv("IMAGE_MEMORY_LIMIT_MB", "0")),
+        )
+    )
+    pipeline = IngestionPipeline(
+        loaders=int(os.getenv("INGESTION_LOADERS", "2")),
+        queue_size=int(os.getenv("INGESTION_QUEUE_SIZE", "4")),
+        batch_wait_ms=float(os.getenv("INGESTION_BATCH_WAIT_MS", "200")),
+    )
+    set_ingestion_pipeline(pipeline)
     # Scheduler
     global scheduler
     scheduler = AsyncIOScheduler()
     scheduler.add_job(
-        remove_unreferenced_content, "interval", minutes=1, args=[async_connection_pool]
+        reindex_stale_content, "interval", minutes=1, args=[async_connection_pool]
     )
     scheduler.add_job(
-        optimize_file_content,
-        "interval",
-        minutes=1,
-        args=[async_connection_pool, scheduler],
+        remove_stale_uploads, "interval", hours=1, args=[async_connection_pool]
     )
     # Syncing
     await migrate(async_connection_pool)
-    await optimize_file_content(async_connection_pool, scheduler)
+    processing_registry = ProcessingRegistry(async_connection_pool)
+    set_processing_registry(processing_registry)
+    await processing_registry.start()
+    # enqueue work missed while no instance was running, jobs are event driven
+    await optimize_file_content(async_connection_pool)
     await remove_unreferenced_content(async_connection_pool)
     # sanity check: await sync_with_db(async_connection_pool)
     scheduler.start()
+    pipeline.start()
+    file_job_worker = FileJobWorker(
+        async_connection_pool,
+        workers=int(os.getenv("FILE_JOB_WORKERS", "2")),
+        poll_interval=float(os.getenv("FILE_JOB_POLL_SECONDS", "60")),
+    )
+    set_file_job_worker(file_job_worker)
+    await file_job_worker.start()
 
 
 async def shutdown():
+    # Stop background imports and file jobs
+    await get_ingestion_pipeline().stop()
+    await get_file_job_worker().stop()
+    await get_processing_registry().stop()
+    get_document_parser().shutdown()
+    get_image_optimizer().shutdown()
     # Close connection pool
     global async_connection_pool
     await async_connection_pool.close()
@@ -125,3 +264,7 @@ async def shutdown():
     global scheduler
     scheduler.wakeup()
     scheduler.shutdown()
+    # Flush embedding cache
+    global sentence_transformer_ef
+    sentence_transformer_ef.close()
+    get_embedding_executor().shutdown()
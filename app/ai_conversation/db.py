@@ -13,7 +13,7 @@ def load_file(name: str):
 def _get_files():
     list_of_files = os.listdir(f"{os.getcwd()}/app/ai_conversation/db_files")
     # filter out files that do not start with a number
-    p = re.compile("^\d+_.*\.sql$")
+    p = re.compile(r"^\d+_.*\.(sql|sh)$")
     new_list = []
     for file in filter(p.match, list_of_files):
         splitted = file.split("_", 1)
@@ -0,0 +1,20 @@
+-- positions of the chunks in their contents, a chunk shared by several
+-- contents (or repeated in one) has a row per position. Rows are removed
+-- with the reference of their content
+
+CREATE TABLE chunk_position (
+  content_id uuid NOT NULL,
+  seq int NOT NULL,
+  chunk_id varchar(64) NOT NULL,
+
+  PRIMARY KEY (content_id, seq),
+  FOREIGN KEY (content_id) REFERENCES uploaded_file_content(id) ON DELETE CASCADE
+);
+
+CREATE INDEX chunk_position_chunk ON chunk_position(chunk_id);
+
+-- positions stored in Chroma are added by file jobs
+
+INSERT INTO file_job(kind, content_id)
+  SELECT 'lexical', id FROM uploaded_file_content
+  ON CONFLICT DO NOTHING;
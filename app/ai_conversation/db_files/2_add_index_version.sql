@@ -0,0 +1,8 @@
+-- splitter config and embedding model the chunks of a content were built with
+
+ALTER TABLE uploaded_file_content ADD COLUMN index_version varchar(64) NULL;
+
+-- failed indexing attempts with failed_index_version, a content is retried
+-- when the version changes again
+ALTER TABLE uploaded_file_content ADD COLUMN index_attempts int NOT NULL DEFAULT 0;
+ALTER TABLE uploaded_file_content ADD COLUMN failed_index_version varchar(64) NULL;
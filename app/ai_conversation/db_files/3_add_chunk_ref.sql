@@ -0,0 +1,13 @@
+-- references of contents to their vectorstore chunks, a chunk is shared by
+-- equal chunks of several contents and deleted with its last reference.
+-- Chroma metadata is only changed while the chunks are locked
+
+CREATE TABLE chunk_ref (
+  content_id uuid NOT NULL,
+  chunk_id varchar(64) NOT NULL,
+
+  PRIMARY KEY (content_id, chunk_id),
+  FOREIGN KEY (content_id) REFERENCES uploaded_file_content(id) ON DELETE CASCADE
+);
+
+CREATE INDEX chunk_ref_chunk ON chunk_ref(chunk_id);
@@ -0,0 +1,20 @@
+-- resumable uploads, the data is stored in files/uploads/<id>.part
+
+CREATE TABLE upload_session (
+  id uuid NOT NULL DEFAULT uuid_generate_v1(),
+  account_id uuid NOT NULL,
+  name varchar(255) NOT NULL,
+  size bigint NOT NULL,
+  received bigint NOT NULL DEFAULT 0,
+  created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  updated_at timestamp NULL,
+
+  PRIMARY KEY (id),
+  FOREIGN KEY (account_id) REFERENCES account(id) ON DELETE CASCADE
+);
+
+CREATE TRIGGER trigger_timestamp_upload_session
+    BEFORE INSERT OR UPDATE
+    ON upload_session
+    FOR EACH ROW
+EXECUTE PROCEDURE trigger_timestamp_create_update_func();
@@ -0,0 +1,3 @@
+-- detected once at upload, NULL for contents uploaded before (filled on download)
+
+ALTER TABLE uploaded_file_content ADD COLUMN mime_type varchar(255) NULL;
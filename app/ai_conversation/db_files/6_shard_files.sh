@@ -0,0 +1,4 @@
+#!/bin/bash
+# moves uploaded files from files/<file_ref> to files/<shard>/<file_ref>
+set -e
+python -m app.ai_conversation.file_handling.file_store
@@ -0,0 +1,63 @@
+-- background work on file contents (optimize, remove), claimed with
+-- FOR UPDATE SKIP LOCKED and leased until locked_until, the handler runs
+-- outside of the claiming transaction. Inserts are announced on the file_job
+-- channel
+
+CREATE TABLE file_job (
+  id uuid NOT NULL DEFAULT uuid_generate_v1(),
+  kind varchar(31) NOT NULL,
+  content_id uuid NOT NULL,
+  attempts int NOT NULL DEFAULT 0,
+  run_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  updated_at timestamp NULL,
+  locked_until timestamp NULL,
+
+  PRIMARY KEY (id),
+  UNIQUE (kind, content_id),
+  FOREIGN KEY (content_id) REFERENCES uploaded_file_content(id) ON DELETE CASCADE
+);
+
+CREATE INDEX file_job_run_at ON file_job(run_at);
+
+CREATE TRIGGER trigger_timestamp_file_job
+    BEFORE INSERT OR UPDATE
+    ON file_job
+    FOR EACH ROW
+EXECUTE PROCEDURE trigger_timestamp_create_update_func();
+
+CREATE OR REPLACE FUNCTION notify_file_job_func()
+    RETURNS trigger AS
+$$
+BEGIN
+    PERFORM pg_notify('file_job', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_notify_file_job
+    AFTER INSERT
+    ON file_job
+    FOR EACH STATEMENT
+EXECUTE PROCEDURE notify_file_job_func();
+
+-- a content may be unreferenced once one of its files is deleted, files
+-- deleted with their content (cascade) do not enqueue its removal
+
+CREATE OR REPLACE FUNCTION enqueue_content_removal_func()
+    RETURNS trigger AS
+$$
+BEGIN
+    INSERT INTO file_job(kind, content_id)
+      SELECT 'remove', OLD.content_id
+        WHERE EXISTS (SELECT 1 FROM uploaded_file_content WHERE id = OLD.content_id)
+      ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_enqueue_content_removal
+    AFTER DELETE
+    ON uploaded_file
+    FOR EACH ROW
+EXECUTE PROCEDURE enqueue_content_removal_func();
@@ -0,0 +1,22 @@
+-- file_refs which are being imported, re-indexed or optimized, shared by all
+-- instances. Leases are renewed while the work runs and expire if the
+-- instance dies.
+
+CREATE TABLE processing_lease (
+  file_ref uuid NOT NULL,
+  task varchar(31) NOT NULL,
+  owner varchar(255) NOT NULL,
+  expires_at timestamp NOT NULL,
+  created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  updated_at timestamp NULL,
+
+  PRIMARY KEY (file_ref)
+);
+
+CREATE INDEX processing_lease_owner ON processing_lease(owner);
+
+CREATE TRIGGER trigger_timestamp_processing_lease
+    BEFORE INSERT OR UPDATE
+    ON processing_lease
+    FOR EACH ROW
+EXECUTE PROCEDURE trigger_timestamp_create_update_func();
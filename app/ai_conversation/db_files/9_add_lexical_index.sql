@@ -0,0 +1,39 @@
+-- inverted index of the vectorstore chunks for BM25 search. Chunks are
+-- indexed once and searched through the references in chunk_ref, they are
+-- deleted with the vectorstore chunk
+
+CREATE TABLE lexical_chunk (
+  id varchar(64) NOT NULL,
+  length int NOT NULL,
+  created_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+  PRIMARY KEY (id)
+);
+
+-- looked up per chunk of the searched contents
+CREATE TABLE lexical_posting (
+  chunk_id varchar(64) NOT NULL,
+  term varchar(64) NOT NULL,
+  tf int NOT NULL,
+
+  PRIMARY KEY (chunk_id, term),
+  FOREIGN KEY (chunk_id) REFERENCES lexical_chunk(id) ON DELETE CASCADE
+);
+
+-- chunk count and total length per content, BM25 statistics of the searched
+-- contents are summed from these rows instead of their chunks
+
+CREATE TABLE lexical_content (
+  content_id uuid NOT NULL,
+  chunks int NOT NULL,
+  length bigint NOT NULL,
+
+  PRIMARY KEY (content_id),
+  FOREIGN KEY (content_id) REFERENCES uploaded_file_content(id) ON DELETE CASCADE
+);
+
+-- chunks written before the index existed are added by file jobs
+
+INSERT INTO file_job(kind, content_id)
+  SELECT 'lexical', id FROM uploaded_file_content
+  ON CONFLICT DO NOTHING;
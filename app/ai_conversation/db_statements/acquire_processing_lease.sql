@@ -0,0 +1,8 @@
+INSERT INTO processing_lease(file_ref, task, owner, expires_at)
+  VALUES ($1, $2, $3, NOW() + make_interval(secs => $4))
+  ON CONFLICT (file_ref) DO UPDATE
+    SET task = EXCLUDED.task,
+        owner = EXCLUDED.owner,
+        expires_at = EXCLUDED.expires_at
+    WHERE processing_lease.expires_at < NOW()
+  RETURNING file_ref;
@@ -0,0 +1,12 @@
+-- $1 lease seconds
+UPDATE file_job
+  SET locked_until = NOW() + make_interval(secs => $1)
+  WHERE id = (
+    SELECT id
+      FROM file_job
+      WHERE run_at <= NOW() AND (locked_until IS NULL OR locked_until <= NOW())
+      ORDER BY run_at
+      LIMIT 1
+      FOR UPDATE SKIP LOCKED
+  )
+  RETURNING *;
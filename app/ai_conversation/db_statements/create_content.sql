@@ -1,6 +1,6 @@
 WITH inserted AS (
-    INSERT INTO uploaded_file_content(hash, file_ref, unprocessed)
-      VALUES ($1, $2, $3)
+    INSERT INTO uploaded_file_content(hash, file_ref, unprocessed, mime_type)
+      VALUES ($1, $2, $3, $4)
       ON CONFLICT DO NOTHING
       RETURNING *
 ) SELECT * FROM inserted
@@ -0,0 +1,3 @@
+DELETE FROM upload_session
+  WHERE COALESCE(updated_at, created_at) < NOW() - make_interval(hours => $1)
+  RETURNING id;
@@ -0,0 +1,9 @@
+INSERT INTO file_job(kind, content_id)
+  SELECT 'optimize', id
+    FROM uploaded_file_content c
+    WHERE unprocessed = true
+      AND NOT EXISTS (
+        SELECT 1 FROM processing_lease l
+          WHERE l.file_ref = c.file_ref AND l.expires_at > NOW()
+      )
+  ON CONFLICT DO NOTHING;
@@ -0,0 +1,11 @@
+INSERT INTO file_job(kind, content_id, run_at)
+  SELECT 'remove', c.id, NOW() + make_interval(secs => $1)
+    FROM uploaded_file_content c
+      LEFT JOIN uploaded_file f
+      ON c.id = f.content_id
+    WHERE f.content_id IS NULL
+      AND NOT EXISTS (
+        SELECT 1 FROM processing_lease l
+          WHERE l.file_ref = c.file_ref AND l.expires_at > NOW()
+      )
+  ON CONFLICT DO NOTHING;
@@ -0,0 +1,12 @@
+-- chunks around the given chunks, in one of the given contents which has them
+-- $1 chunk ids, $2 content ids, $3 chunks on each side
+WITH hit AS (
+  SELECT DISTINCT ON (chunk_id) chunk_id, content_id, seq
+    FROM chunk_position
+    WHERE chunk_id = ANY($1::varchar[]) AND content_id = ANY($2::uuid[])
+    ORDER BY chunk_id, content_id, seq
+)
+SELECT h.chunk_id AS hit_id, h.seq AS hit_seq, p.content_id, p.seq, p.chunk_id
+  FROM hit h
+    JOIN chunk_position p
+    ON p.content_id = h.content_id AND p.seq BETWEEN h.seq - $3 AND h.seq + $3;
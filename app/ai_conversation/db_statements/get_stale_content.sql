@@ -0,0 +1,10 @@
+SELECT *
+  FROM uploaded_file_content c
+  WHERE index_version IS DISTINCT FROM $1
+    AND (failed_index_version IS DISTINCT FROM $1 OR index_attempts < $3)
+    AND NOT EXISTS (
+      SELECT 1 FROM processing_lease l
+        WHERE l.file_ref = c.file_ref AND l.expires_at > NOW()
+    )
+  ORDER BY updated_at NULLS FIRST, created_at
+  LIMIT $2;
@@ -0,0 +1,8 @@
+-- locks the chunks until the end of the transaction, they do not need a row.
+-- Locks are taken in the order of their keys, chunks with the same key share
+-- one
+-- $1 chunk ids
+SELECT pg_advisory_xact_lock(1, key)
+  FROM (
+    SELECT DISTINCT hashtext(id) AS key FROM unnest($1::varchar[]) AS id ORDER BY key
+  ) keys;
@@ -0,0 +1,14 @@
+-- recounts the BM25 statistics of a content, its row is locked by the caller
+-- so that references changed meanwhile are counted once
+-- $1 content id
+UPDATE lexical_content s
+  SET chunks = counts.chunks,
+      length = counts.length
+  FROM (
+    SELECT count(*) AS chunks, COALESCE(sum(c.length), 0) AS length
+      FROM chunk_ref r
+        JOIN lexical_chunk c
+        ON c.id = r.chunk_id
+      WHERE r.content_id = $1
+  ) counts
+  WHERE s.content_id = $1;
@@ -0,0 +1,14 @@
+-- removes released references from the BM25 statistics
+-- $1 content ids, $2 chunk ids of the released references
+WITH counts AS (
+  SELECT r.content_id, count(*) AS chunks, sum(c.length) AS length
+    FROM unnest($1::uuid[], $2::varchar[]) AS r(content_id, chunk_id)
+      JOIN lexical_chunk c
+      ON c.id = r.chunk_id
+    GROUP BY r.content_id
+)
+UPDATE lexical_content s
+  SET chunks = s.chunks - counts.chunks,
+      length = s.length - counts.length
+  FROM counts
+  WHERE s.content_id = counts.content_id;
@@ -0,0 +1,36 @@
+-- BM25 over the chunks of the given contents, read through their references
+-- so the cost grows with the searched contents and not with the index. A
+-- chunk shared by several of them counts once per content in the statistics.
+-- Terms below the minimum IDF (in most of the chunks) are not scored
+-- $1 content ids, $2 terms, $3 k1, $4 b, $5 limit, $6 minimum IDF
+WITH stats AS (
+  SELECT GREATEST(sum(chunks), 1) AS n,
+         GREATEST(sum(length)::float8 / GREATEST(sum(chunks), 1), 1) AS avg_length
+    FROM lexical_content
+    WHERE content_id = ANY($1::uuid[])
+), matches AS (
+  SELECT p.term, p.chunk_id, p.tf
+    FROM chunk_ref r
+      JOIN lexical_posting p
+      ON p.chunk_id = r.chunk_id AND p.term = ANY($2::varchar[])
+    WHERE r.content_id = ANY($1::uuid[])
+), idf AS (
+  SELECT m.term, ln(1 + (s.n - count(*) + 0.5) / (count(*) + 0.5)) AS idf
+    FROM matches m
+      CROSS JOIN stats s
+    GROUP BY m.term, s.n
+)
+SELECT m.chunk_id,
+       sum(
+         idf.idf * m.tf * ($3::float8 + 1)
+         / (m.tf + $3::float8 * (1 - $4::float8 + $4::float8 * c.length / s.avg_length))
+       ) AS score
+  FROM (SELECT DISTINCT term, chunk_id, tf FROM matches) m
+    JOIN idf
+    ON idf.term = m.term AND idf.idf >= $6::float8
+    JOIN lexical_chunk c
+    ON c.id = m.chunk_id
+    CROSS JOIN stats s
+  GROUP BY m.chunk_id
+  ORDER BY score DESC
+  LIMIT $5;
@@ -0,0 +1,99 @@
+import os
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# torch: full precision PyTorch (previous behaviour)
+# torch-int8: PyTorch with dynamically quantized linear layers
+# onnx / onnx-int8: ONNX Runtime, needs `optimum[onnxruntime]` to be installed
+EMBEDDING_BACKENDS = ["torch", "torch-int8", "onnx", "onnx-int8"]
+
+PARITY_TEXTS = [
+    "What is the difference between a process and a thread?",
+    "Wann findet die Klausur statt?",
+    "Can you explain the proof of theorem 3.2 again?",
+    "The lecture slides for week 5 are missing.",
+    "Wie berechnet man die Determinante einer 3x3 Matrix?",
+    "Is attendance mandatory for the exercises?",
+]
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Sentence transformer embeddings, independent of the inference backend."""
+
+    def __init__(self, client, encode_kwargs: dict = None):
+        self.client = client
+        self.encode_kwargs = encode_kwargs or {}
+
+    def embed_array(self, texts: list[str]) -> np.ndarray:
+        # same preprocessing as langchain's HuggingFaceEmbeddings
+        texts = [text.replace("\n", " ") for text in texts]
+        return self.client.encode(
+            texts, convert_to_numpy=True, show_progress_bar=False, **self.encode_kwargs
+        )
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def create_embedding_backend(
+    model_name: str, backend: str = "torch"
+) -> SentenceTransformerEmbeddings:
+    from sentence_transformers import SentenceTransformer
+
+    match backend:
+        case "torch":
+            client = SentenceTransformer(model_name, device="cpu")
+        case "torch-int8":
+            import torch
+
+            client = SentenceTransformer(model_name, device="cpu")
+            torch.quantization.quantize_dynamic(
+                client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        case "onnx":
+            client = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        case "onnx-int8":
+            file_name = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+            client = SentenceTransformer(
+                model_name,
+                device="cpu",
+                backend="onnx",
+                model_kwargs={"file_name": file_name},
+            )
+        case _:
+            raise ValueError(
+                f"Unknown embedding backend {backend}, expected one of {EMBEDDING_BACKENDS}"
+            )
+    return SentenceTransformerEmbeddings(client)
+
+
+def check_parity(
+    candidate: SentenceTransformerEmbeddings,
+    reference: SentenceTransformerEmbeddings,
+    texts: list[str] = PARITY_TEXTS,
+) -> float:
+    """Returns the lowest cosine similarity between both backends."""
+    a = candidate.embed_array(texts)
+    b = reference.embed_array(texts)
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float(np.min(np.sum(a * b, axis=1)))
+
+
+def load_embedding_backend(model_name: str, backend: str) -> tuple[Embeddings, str]:
+    """Loads the configured backend, falling back to torch if it is not close
+    enough to the full precision vectors already stored in Chroma."""
+    embeddings = create_embedding_backend(model_name, backend)
+    if backend == "torch" or os.getenv("EMBEDDING_PARITY_CHECK", "true") != "true":
+        return embeddings, backend
+    threshold = float(os.getenv("EMBEDDING_PARITY_THRESHOLD", "0.99"))
+    reference = create_embedding_backend(model_name, "torch")
+    similarity = check_parity(embeddings, reference)
+    print(f"Embedding backend {backend}: min cosine similarity {similarity:.4f}")
+    if similarity < threshold:
+        print(f"Embedding backend {backend} failed parity check, using torch")
+        return reference, "torch"
+    return embeddings, backend
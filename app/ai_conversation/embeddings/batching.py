@@ -0,0 +1,72 @@
+import asyncio
+from langchain_core.embeddings import Embeddings
+
+
+class MicroBatchingEmbeddings(Embeddings):
+    """Coalesces concurrent async embedding calls into shared batches."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5,
+    ):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending: list[tuple[list[str], asyncio.Future]] = []
+        self._pending_count = 0
+        self._flush_handle: asyncio.TimerHandle = None
+        self._tasks = set()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        if len(texts) < 1:
+            return []
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((texts, future))
+        self._pending_count += len(texts)
+        if self._pending_count >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending = self._pending
+        self._pending = []
+        self._pending_count = 0
+        if not pending:
+            return
+        task = asyncio.create_task(self._run_batch(pending))
+        # keep a reference, otherwise the task could be garbage collected
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, pending: list[tuple[list[str], asyncio.Future]]):
+        texts = [text for batch, _ in pending for text in batch]
+        try:
+            vectors = await self.embeddings.aembed_documents(texts)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        offset = 0
+        for batch, future in pending:
+            # caller may have been cancelled (client disconnected)
+            if not future.done():
+                future.set_result(vectors[offset : offset + len(batch)])
+            offset += len(batch)
@@ -0,0 +1,219 @@
+import fcntl
+import itertools
+import os
+import re
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+KEY_SIZE = 32
+
+
+def make_key(model_name: str, text: str) -> bytes:
+    return sha256(model_name.encode() + b"\0" + text.encode()).digest()
+
+
+class DiskEmbeddingStore:
+    """Append-only store of float32 rows, read through a memory map.
+
+    `<name>.keys` holds one sha256 digest per row, `<name>.f32` the vectors in
+    the same order. Rows are never rewritten, so a crash can at most leave a
+    partial row or a row without key at the end, which is cut off on the next
+    start. The dimension comes from the model, it can not be derived from the
+    file sizes once they disagree.
+
+    The files have a single writer. A process holds an exclusive lock on
+    `<name>.<slot>.lock` while it has them open and other processes (e.g.
+    uvicorn workers) take the next free slot, so they neither append to nor
+    truncate files in use. A restarted process takes over the slot and the
+    rows of its predecessor.
+    """
+
+    def __init__(self, directory: str, model_name: str, max_rows: int, dimension: int):
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r"[^\w.-]", "_", model_name)
+        self._lock_file, slot = self._lock_slot(f"{directory}/{name}")
+        # slot 0 keeps the names of the files from before there were slots
+        prefix = f"{directory}/{name}" if slot == 0 else f"{directory}/{name}.{slot}"
+        self.keys_path = f"{prefix}.keys"
+        self.data_path = f"{prefix}.f32"
+        self.max_rows = max_rows
+        self.dimension = dimension
+        self.rows: dict[bytes, int] = {}
+        self._map: np.memmap = None
+        self._load()
+        self._keys_file = open(self.keys_path, "ab")
+        self._data_file = open(self.data_path, "ab")
+
+    @staticmethod
+    def _lock_slot(prefix: str):
+        # slots are only added for processes running at the same time
+        for slot in itertools.count():
+            lock_file = open(f"{prefix}.{slot}.lock", "ab")
+            try:
+                # released by the OS when the process dies
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file, slot
+            except BlockingIOError:
+                lock_file.close()
+
+    def _load(self) -> None:
+        keys = b""
+        if os.path.isfile(self.keys_path):
+            with open(self.keys_path, "rb") as f:
+                keys = f.read()
+        data_size = (
+            os.path.getsize(self.data_path) if os.path.isfile(self.data_path) else 0
+        )
+        count = min(len(keys) // KEY_SIZE, data_size // 4 // self.dimension)
+        with open(self.keys_path, "ab") as f:
+            f.truncate(count * KEY_SIZE)
+        with open(self.data_path, "ab") as f:
+            f.truncate(count * 4 * self.dimension)
+        for i in range(count):
+            self.rows[keys[i * KEY_SIZE : (i + 1) * KEY_SIZE]] = i
+
+    def get(self, key: bytes) -> np.ndarray | None:
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        if self._map is None or row >= self._map.shape[0]:
+            self._data_file.flush()
+            self._map = np.memmap(
+                self.data_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self.rows), self.dimension),
+            )
+        return np.array(self._map[row])
+
+    def put(self, key: bytes, vector: np.ndarray) -> None:
+        if key in self.rows or len(self.rows) >= self.max_rows:
+            return
+        if self.dimension != vector.shape[0]:
+            return
+        self._data_file.write(vector.astype(np.float32).tobytes())
+        self._keys_file.write(key)
+        self.rows[key] = len(self.rows)
+
+    def flush(self) -> None:
+        self._data_file.flush()
+        self._keys_file.flush()
+
+    def close(self) -> None:
+        self._map = None
+        self._data_file.close()
+        self._keys_file.close()
+        self._lock_file.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """Content-addressed embedding cache (LRU in memory, optionally on disk)."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str,
+        max_entries: int = 10_000,
+        disk_store: DiskEmbeddingStore = None,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.disk_store = disk_store
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        # sync methods are called from executor threads (e.g. by Chroma)
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "disk_entries": len(self.disk_store.rows) if self.disk_store else 0,
+            }
+
+    def _lookup(self, keys: list[bytes]) -> list[np.ndarray | None]:
+        found = []
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                elif self.disk_store and (vector := self.disk_store.get(key)) is not None:
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+                found.append(vector)
+        return found
+
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _store(self, keys: list[bytes], vectors: list[list[float]]) -> None:
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                if self.disk_store:
+                    self.disk_store.put(key, vector)
+            if self.disk_store:
+                self.disk_store.flush()
+
+    def _prepare(self, texts: list[str]):
+        keys = [make_key(self.model_name, text) for text in texts]
+        found = self._lookup(keys)
+        # deduplicate misses, a batch often contains the same text twice
+        missing: dict[bytes, str] = {}
+        for key, text, vector in zip(keys, texts, found):
+            if vector is None:
+                missing[key] = text
+        return keys, found, missing
+
+    def _assemble(self, keys, found, missing, vectors) -> list[list[float]]:
+        computed = dict(zip(missing.keys(), vectors))
+        self._store(list(missing.keys()), vectors)
+        return [
+            vector.tolist() if vector is not None else list(computed[key])
+            for key, vector in zip(keys, found)
+        ]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, found, missing = self._prepare(texts)
+        vectors = (
+            self.embeddings.embed_documents(list(missing.values())) if missing else []
+        )
+        return self._assemble(keys, found, missing, vectors)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, found, missing = self._prepare(texts)
+        vectors = (
+            await self.embeddings.aembed_documents(list(missing.values()))
+            if missing
+            else []
+        )
+        return self._assemble(keys, found, missing, vectors)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def close(self) -> None:
+        if self.disk_store:
+            with self._lock:
+                self.disk_store.close()
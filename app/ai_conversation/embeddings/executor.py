@@ -0,0 +1,60 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingExecutor:
+    """Dedicated thread pool for model inference with a bounded queue.
+
+    At most `max_workers + max_queue` jobs are submitted at once, further
+    callers wait for a free slot instead of piling up in the pool.
+    """
+
+    def __init__(self, max_workers: int = 1, max_queue: int = 16):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="embedding"
+        )
+        self._slots = asyncio.Semaphore(max_workers + max_queue)
+
+    async def run(self, func, *args, **kwargs):
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, partial(func, *args, **kwargs)
+            )
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class OffloadedEmbeddings(Embeddings):
+    """Runs the async embedding methods on an EmbeddingExecutor."""
+
+    def __init__(self, embeddings: Embeddings, executor: EmbeddingExecutor):
+        self.embeddings = embeddings
+        self.executor = executor
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.executor.run(self.embeddings.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.executor.run(self.embeddings.embed_query, text)
+
+
+embedding_executor: EmbeddingExecutor = None
+
+
+def set_embedding_executor(executor: EmbeddingExecutor):
+    global embedding_executor
+    embedding_executor = executor
+
+
+def get_embedding_executor() -> EmbeddingExecutor:
+    global embedding_executor
+    return embedding_executor
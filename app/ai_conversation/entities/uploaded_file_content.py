@@ -3,6 +3,7 @@ from app.ai_conversation.db_decorator import entity
 from dataclasses import dataclass
 from uuid import UUID
 from datetime import datetime
+from typing import Optional
 
 @entity
 @dataclass
@@ -11,4 +12,6 @@ class UploadedFileContent:
     hash: str
     file_ref: UUID
     unprocessed: bool
-    created_at: datetime = datetime.now()
\ No newline at end of file
+    created_at: datetime = datetime.now()
+    index_version: Optional[str] = None
+    mime_type: Optional[str] = None
\ No newline at end of file
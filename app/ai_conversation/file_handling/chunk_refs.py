@@ -0,0 +1,163 @@
+import asyncio
+from typing import Callable
+from uuid import UUID
+from langchain_core.documents import Document
+from app.ai_conversation.db import load_file
+from app.ai_conversation.file_handling.lexical_index import get_lexical_index
+
+lock_chunks = load_file("lock_chunks")
+get_chunk_windows = load_file("get_chunk_windows")
+
+
+class ChunkRefs:
+    """References of contents to their vectorstore chunks.
+
+    Equal chunks of several contents are stored once, the rows in chunk_ref
+    are their reference count. References are changed in a transaction which
+    locks the chunks, and the vectorstore is written while the lock is held,
+    so a chunk is not deleted while another content adds a reference to it.
+    The lexical index and the positions of the chunks in their contents are
+    written in the same transaction.
+    """
+
+    def __init__(self, async_connection_pool):
+        self.pool = async_connection_pool
+
+    async def add(
+        self, docs: list[Document], write: Callable[[list[Document]], list[Document]]
+    ) -> None:
+        """Adds the references of the documents. write is called while the
+        chunks are locked, it stores them in the vectorstore and returns the
+        documents to add."""
+        ids = list(set(doc.metadata["id"] for doc in docs))
+        if not ids:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # a content deleted meanwhile gets no references, deleting it
+                # waits for this transaction. Locked before the chunks, its
+                # removal holds the row while releasing them.
+                rows = await conn.fetch(
+                    """SELECT id FROM uploaded_file_content
+                         WHERE id = ANY($1::uuid[])
+                         ORDER BY id
+                         FOR KEY SHARE;""",
+                    list(set(UUID(doc.metadata["ref_id"]) for doc in docs)),
+                )
+                existing = set(str(row["id"]) for row in rows)
+                docs = [doc for doc in docs if doc.metadata["ref_id"] in existing]
+                if not docs:
+                    return
+                await conn.execute(lock_chunks, ids)
+                docs = await asyncio.to_thread(write, docs)
+                texts = {doc.metadata["id"]: doc.page_content for doc in docs}
+                positions = {
+                    (UUID(doc.metadata["ref_id"]), doc.metadata["seq"]): doc.metadata["id"]
+                    for doc in docs
+                    if "seq" in doc.metadata
+                }
+                pairs = sorted(
+                    set((UUID(doc.metadata["ref_id"]), doc.metadata["id"]) for doc in docs)
+                )
+                if not pairs:
+                    return
+                rows = await conn.fetch(
+                    """INSERT INTO chunk_ref(content_id, chunk_id)
+                         SELECT * FROM unnest($1::uuid[], $2::varchar[])
+                         ON CONFLICT DO NOTHING
+                         RETURNING content_id, chunk_id;""",
+                    *map(list, zip(*pairs)),
+                )
+                await get_lexical_index().add(conn, texts, rows)
+                if positions:
+                    values = [(*key, id) for key, id in sorted(positions.items())]
+                    # a re-indexed content gets new chunks at the same positions
+                    await conn.execute(
+                        """INSERT INTO chunk_position(content_id, seq, chunk_id)
+                             SELECT * FROM unnest($1::uuid[], $2::int[], $3::varchar[])
+                             ON CONFLICT (content_id, seq) DO UPDATE
+                               SET chunk_id = EXCLUDED.chunk_id;""",
+                        *map(list, zip(*values)),
+                    )
+
+    async def get_chunk_ids(self, ref_ids: list[UUID | str], limit: int) -> list[str]:
+        """Chunks referenced by the contents."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """SELECT DISTINCT chunk_id FROM chunk_ref
+                     WHERE content_id = ANY($1::uuid[])
+                     ORDER BY chunk_id
+                     LIMIT $2;""",
+                [UUID(str(ref_id)) for ref_id in ref_ids],
+                limit,
+            )
+        return [row["chunk_id"] for row in rows]
+
+    async def release(
+        self,
+        ref_ids: list[UUID | str],
+        ids: list[str],
+        write: Callable[[dict[str, list[str]]], list[str]],
+    ) -> None:
+        """Removes the references of the contents from the chunks. write gets
+        the remaining references of every chunk while the chunks are locked,
+        it updates the vectorstore and returns the chunks it deleted."""
+        if not ids:
+            return
+        ref_ids = [UUID(str(ref_id)) for ref_id in ref_ids]
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(lock_chunks, ids)
+                released = await conn.fetch(
+                    """DELETE FROM chunk_ref
+                         WHERE content_id = ANY($1::uuid[]) AND chunk_id = ANY($2::varchar[])
+                         RETURNING content_id, chunk_id;""",
+                    ref_ids,
+                    ids,
+                )
+                await get_lexical_index().release(conn, released)
+                await conn.execute(
+                    """DELETE FROM chunk_position
+                         WHERE content_id = ANY($1::uuid[]) AND chunk_id = ANY($2::varchar[]);""",
+                    ref_ids,
+                    ids,
+                )
+                remaining: dict[str, list[str]] = {id: [] for id in ids}
+                for row in await conn.fetch(
+                    """SELECT chunk_id, array_agg(content_id) AS refs FROM chunk_ref
+                         WHERE chunk_id = ANY($1::varchar[])
+                         GROUP BY chunk_id;""",
+                    ids,
+                ):
+                    remaining[row["chunk_id"]] = [str(ref) for ref in row["refs"]]
+                deleted = await asyncio.to_thread(write, remaining)
+                await get_lexical_index().delete(conn, deleted)
+
+    async def get_windows(
+        self, ids: list[str], ref_ids: list[UUID | str], window: int
+    ) -> list:
+        """Positions of the chunks in one of the contents and the chunks up to
+        window positions before and after them, rows of (hit_id, hit_seq,
+        content_id, seq, chunk_id)."""
+        if not ids or not ref_ids:
+            return []
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(
+                get_chunk_windows,
+                ids,
+                [UUID(str(ref_id)) for ref_id in ref_ids],
+                window,
+            )
+
+
+chunk_refs: ChunkRefs = None
+
+
+def set_chunk_refs(refs: ChunkRefs):
+    global chunk_refs
+    chunk_refs = refs
+
+
+def get_chunk_refs() -> ChunkRefs:
+    global chunk_refs
+    return chunk_refs
@@ -0,0 +1,164 @@
+import asyncio
+import traceback
+from typing import Callable
+from uuid import UUID
+from app.ai_conversation.db import load_file
+from app.ai_conversation.entities.uploaded_file_content import UploadedFileContent
+from app.ai_conversation.file_handling.file_upload_processor import (
+    _process_file,
+    lock_unreferenced_content,
+    remove_content,
+)
+from app.ai_conversation.file_handling.processing_registry import (
+    get_processing_registry,
+)
+from app.ai_conversation.file_handling.vectorstore import index_lexical
+
+claim_file_job = load_file("claim_file_job")
+
+CHANNEL = "file_job"
+MAX_ATTEMPTS = 5
+# delay before a job is tried again, doubled per attempt
+RETRY_DELAY_SECONDS = 30
+MAX_RETRY_DELAY_SECONDS = 3600
+# a job whose worker did not finish it in this time is claimed again
+JOB_LEASE_SECONDS = 900
+
+
+class RetryLater(Exception):
+    """The content is busy, the job is tried again without counting it as an
+    attempt."""
+
+
+class FileJobWorker:
+    """Runs jobs from the file_job table.
+
+    Jobs are claimed with FOR UPDATE SKIP LOCKED and leased until
+    locked_until, so every replica can run workers without two of them taking
+    the same job. The handler runs without holding a transaction or
+    connection, and a job of a crashed worker is claimed again once its lease
+    expired. Workers sleep until
+    a job is inserted (LISTEN/NOTIFY) or the poll interval passed, which picks
+    up delayed retries.
+    """
+
+    def __init__(self, async_connection_pool, workers: int = 2, poll_interval: float = 60):
+        self.pool = async_connection_pool
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.handlers: dict[str, Callable] = {
+            "optimize": self._optimize,
+            "remove": self._remove,
+            "lexical": self._index_lexical,
+        }
+        self.tasks: list[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._listener = None
+
+    async def start(self) -> None:
+        self._listener = await self.pool.acquire()
+        await self._listener.add_listener(CHANNEL, self._on_notify)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self._listener is not None:
+            await self._listener.remove_listener(CHANNEL, self._on_notify)
+            await self.pool.release(self._listener)
+            self._listener = None
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        self._wakeup.set()
+
+    async def _worker(self) -> None:
+        while True:
+            # cleared before claiming, a job inserted meanwhile sets it again
+            self._wakeup.clear()
+            try:
+                if await self._run_next():
+                    continue
+            except Exception:
+                print(traceback.format_exc())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_next(self) -> bool:
+        async with self.pool.acquire() as conn:
+            job = await conn.fetchrow(claim_file_job, float(JOB_LEASE_SECONDS))
+        if job is None:
+            return False
+        try:
+            await self.handlers[job["kind"]](job["content_id"])
+        except RetryLater:
+            await self._retry(job, count=False)
+            return True
+        except Exception:
+            print(traceback.format_exc())
+            await self._retry(job)
+            return True
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM file_job WHERE id = $1;", job["id"])
+        return True
+
+    async def _retry(self, job, count: bool = True) -> None:
+        attempts = job["attempts"] + (1 if count else 0)
+        async with self.pool.acquire() as conn:
+            if attempts >= MAX_ATTEMPTS:
+                print(f"Giving up {job['kind']} job for content {job['content_id']}")
+                await conn.execute("DELETE FROM file_job WHERE id = $1;", job["id"])
+                return
+            delay = min(RETRY_DELAY_SECONDS * 2**attempts, MAX_RETRY_DELAY_SECONDS)
+            await conn.execute(
+                "UPDATE file_job SET attempts = $2, run_at = NOW() + make_interval(secs => $3), locked_until = NULL WHERE id = $1;",
+                job["id"],
+                attempts,
+                float(delay),
+            )
+
+    async def _optimize(self, content_id: UUID) -> None:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT * FROM uploaded_file_content WHERE id = $1;", content_id
+            )
+        if row is None or not row["unprocessed"]:
+            return
+        registry = get_processing_registry()
+        if not await registry.acquire(row["file_ref"], "optimize"):
+            raise RetryLater()
+        try:
+            await _process_file(UploadedFileContent.load_from_db(row), self.pool)
+        finally:
+            await registry.release(row["file_ref"])
+
+    async def _remove(self, content_id: UUID) -> None:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await lock_unreferenced_content(conn, content_id)
+                if row is None:
+                    return
+                if await get_processing_registry().is_processing(row["file_ref"]):
+                    raise RetryLater()
+                # the job is deleted with the content, it stays if this fails
+                await remove_content(conn, row)
+
+    async def _index_lexical(self, content_id: UUID) -> None:
+        # chunks written while this runs are added by the import itself
+        await index_lexical(content_id)
+
+
+file_job_worker: FileJobWorker = None
+
+
+def set_file_job_worker(worker: FileJobWorker):
+    global file_job_worker
+    file_job_worker = worker
+
+
+def get_file_job_worker() -> FileJobWorker:
+    global file_job_worker
+    return file_job_worker
@@ -0,0 +1,79 @@
+import os
+import sys
+from typing import Iterator
+from uuid import UUID
+
+# this module is run by a migration, keep its imports light
+
+# files are stored in files/<first two hex digits of file_ref>/<file_ref>,
+# file_refs are random, so the 256 shards fill evenly
+SHARD_LENGTH = 2
+
+
+def get_files_dir() -> str:
+    return f"{os.getcwd()}/files"
+
+
+def get_flat_file_path(file_ref: UUID | str) -> str:
+    return f"{get_files_dir()}/{file_ref}"
+
+
+def get_file_path(file_ref: UUID | str) -> str:
+    file_ref = str(file_ref)
+    path = f"{get_files_dir()}/{file_ref[:SHARD_LENGTH]}/{file_ref}"
+    # files of the old flat layout which were not moved yet
+    if not os.path.exists(path) and os.path.isfile(get_flat_file_path(file_ref)):
+        return get_flat_file_path(file_ref)
+    return path
+
+
+def iter_files() -> Iterator[UUID]:
+    """Yields the file_ref of every stored file."""
+    root = get_files_dir()
+    if not os.path.isdir(root):
+        return
+    with os.scandir(root) as shards:
+        for shard in shards:
+            if shard.is_file():
+                # not moved into its shard yet
+                try:
+                    yield UUID(shard.name)
+                except ValueError:
+                    pass
+                continue
+            if len(shard.name) != SHARD_LENGTH or not shard.is_dir():
+                continue
+            with os.scandir(shard.path) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    try:
+                        yield UUID(entry.name)
+                    except ValueError:
+                        continue
+
+
+def shard_flat_files() -> int:
+    """Moves files of the old flat layout into their shards."""
+    root = get_files_dir()
+    if not os.path.isdir(root):
+        return 0
+    moved = 0
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            try:
+                file_ref = UUID(entry.name)
+            except ValueError:
+                continue
+            path = f"{root}/{str(file_ref)[:SHARD_LENGTH]}/{file_ref}"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(entry.path, path)
+            moved += 1
+    return moved
+
+
+if __name__ == "__main__":
+    moved = shard_flat_files()
+    print(f"Moved {moved} files into shards", file=sys.stderr)
@@ -1,24 +1,31 @@
+import asyncio
 import os
 import shutil
+from functools import partial
 from typing import List
 from uuid import UUID
 from fastapi import HTTPException, UploadFile
-import aiofiles
 from hashlib import sha256
 import base64
 
-from fastapi.responses import FileResponse
-import magic
+from fastapi.responses import FileResponse, Response
 from app.ai_conversation.db import load_file
-from app.ai_conversation.ai_conversation import get_connection_pool, get_scheduler
+from app.ai_conversation.ai_conversation import get_connection_pool
 from app.ai_conversation.entities.uploaded_file_content import UploadedFileContent
+from app.ai_conversation.file_handling.file_store import get_file_path, get_files_dir
 from app.ai_conversation.file_handling.file_upload_processor import (
+    detect_mime_type,
     generate_file_path,
     remove_files,
-    currently_processing,
-    _add_optimize_job,
+    enqueue_file_job,
 )
-from app.ai_conversation.file_handling.vectorstore import import_to_vectorstore
+from app.ai_conversation.file_handling.ingestion import get_ingestion_pipeline
+from app.ai_conversation.file_handling.processing_registry import (
+    get_processing_registry,
+)
+from app.ai_conversation.file_handling.reindexer import mark_indexed
+from app.ai_conversation.file_handling.vectorstore import get_index_version
+from app.ai_conversation.threads.retrieval_context import get_retrieval_context_cache
 
 create_content = load_file("create_content")
 create_file = load_file("create_file")
@@ -34,36 +41,86 @@ async def handle_file_upload(files: List[UploadFile], user_id: UUID) -> list[dic
             )
             continue
         hash, file_ref = result
-        row = await _find_content_by_hash(hash, file_ref)
-        is_new = row["file_ref"] == file_ref
-        import_result = None
-        if is_new:
-            currently_processing[file_ref] = {"vector": True, "optimize": True}
-            # first extract for vector
-            try:
-                import_result = await import_to_vectorstore(
-                    UploadedFileContent.load_from_db(row)
-                )
-            except Exception as e:
-                import_result = "Failed"
-                print(e)
-            currently_processing[file_ref]["vector"] = False
-            # then optimize
-            await _add_optimize_job(row, get_scheduler(), get_connection_pool())
-        else:
-            remove_files([file_ref])
-        file = await _insert_file(row["id"], user_id, file.filename)
-        results.append(
-            {
-                "result": "OK",
-                "file": dict(file),
-                "isNew": is_new,
-                "importResult": import_result,
-            }
-        )
+        results.append(await register_upload(hash, file_ref, file.filename, user_id))
     return results
 
 
+async def register_upload(
+    hash: str, file_ref: UUID, filename: str, user_id: UUID
+) -> dict:
+    """Adds a file which is already stored under file_ref to the user's files."""
+    # held until the import is done, keeps the new content from being
+    # collected before its file row exists
+    registry = get_processing_registry()
+    await registry.acquire(file_ref, "import")
+    # detected once, stored with the content
+    mime_type = await asyncio.to_thread(
+        detect_mime_type, get_file_path(file_ref)
+    )
+    try:
+        row = await _find_content_by_hash(hash, file_ref, mime_type)
+    except Exception:
+        await registry.release(file_ref)
+        raise
+    is_new = row["file_ref"] == file_ref
+    import_result = None
+    if is_new:
+        # first extract for vector (in background), then optimize
+        import_result = get_ingestion_pipeline().submit(
+            UploadedFileContent.load_from_db(row), partial(_on_imported, row)
+        )
+    else:
+        remove_files([file_ref])
+        await registry.release(file_ref)
+    file = await _insert_file(row["id"], user_id, filename)
+    return {
+        "result": "OK",
+        "file": dict(file),
+        "isNew": is_new,
+        "importResult": import_result,
+    }
+
+
+async def _on_imported(row, import_result: str | bool) -> None:
+    await mark_indexed(get_connection_pool(), row["id"], import_result != "Failed")
+    # optimizing runs as a file job, possibly on another replica
+    await get_processing_registry().release(row["file_ref"])
+    await enqueue_file_job(get_connection_pool(), "optimize", row["id"])
+
+
+async def handle_file_status(file_id: UUID, user_id: UUID) -> dict:
+    async with get_connection_pool().acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT c.id, c.file_ref, c.index_version, c.failed_index_version
+                 FROM uploaded_file f
+                   JOIN uploaded_file_content c
+                   ON c.id = f.content_id
+                 WHERE f.id = $1 and f.account_id = $2;""",
+            file_id,
+            user_id,
+        )
+    if not row:
+        raise HTTPException(status_code=404, detail="File not found")
+    status = get_ingestion_pipeline().get_status(row["id"])
+    if status is not None and status["state"] not in ["done", "failed"]:
+        return status
+    # imported before the last restart, by another instance or re-indexed
+    # since, mark_indexed stores the index version once indexing succeeded
+    if row["index_version"] == get_index_version():
+        state = "done"
+    elif await get_processing_registry().is_processing(row["file_ref"]):
+        state = "processing"
+    elif row["index_version"] is None and row["failed_index_version"] is not None:
+        state = "failed"
+    else:
+        # indexed with an older version or before versions were stored, still
+        # searchable until it is re-indexed
+        state = "stale"
+    if status is not None and status["state"] == state:
+        return status
+    return {"state": state}
+
+
 async def handle_file_list(user_id: UUID):
     async with get_connection_pool().acquire() as conn:
         files = await conn.fetch(
@@ -82,21 +139,42 @@ async def handle_file_delete(file_id: UUID, user_id: UUID):
         )
         if status != "DELETE 1":
             raise HTTPException(status_code=404, detail="File not found")
-        return None
+    # threads of the user must not retrieve from the deleted file
+    get_retrieval_context_cache().invalidate_account(user_id)
+    return None
 
 
-async def handle_file_get(file_id: str, user_id: UUID):
+async def handle_file_get(file_id: str, user_id: UUID, if_none_match: str = None):
     async with get_connection_pool().acquire() as conn:
         file = await conn.fetchrow(
-            "SELECT * FROM uploaded_file WHERE id = $1 and account_id = $2;",
+            """SELECT f.name, c.id AS content_id, c.file_ref, c.mime_type
+               FROM uploaded_file f
+                 JOIN uploaded_file_content c ON c.id = f.content_id
+               WHERE f.id = $1 and f.account_id = $2;""",
             file_id,
             user_id,
         )
         if not file:
             raise HTTPException(status_code=404, detail="File not found")
-        path = f"{os.getcwd()}/files/{file['file_ref']}"
-        media_type = magic.from_file(path, mime=True)
-        return FileResponse(path=path, filename=file["name"], media_type=media_type)
+        # a file_ref is never rewritten, optimizing creates a new one
+        etag = f'"{file["file_ref"]}"'
+        headers = {"etag": etag, "cache-control": "private, no-cache"}
+        if if_none_match and etag in [e.strip() for e in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        path = get_file_path(file["file_ref"])
+        media_type = file["mime_type"]
+        if media_type is None:
+            # uploaded before the type was stored
+            media_type = await asyncio.to_thread(detect_mime_type, path)
+            await conn.execute(
+                "UPDATE uploaded_file_content SET mime_type = $1 WHERE id = $2;",
+                media_type,
+                file["content_id"],
+            )
+        # FileResponse answers range requests itself
+        return FileResponse(
+            path=path, filename=file["name"], media_type=media_type, headers=headers
+        )
 
 
 async def handle_file_info(file_id: UUID, user_id: UUID):
@@ -115,9 +193,13 @@ async def handle_file_info(file_id: UUID, user_id: UUID):
         }
 
 
-async def _find_content_by_hash(hash: str, file_ref: str, unprocessed: bool = True):
+async def _find_content_by_hash(
+    hash: str, file_ref: str, mime_type: str, unprocessed: bool = True
+):
     async with get_connection_pool().acquire() as conn:
-        return await conn.fetchrow(create_content, hash, file_ref, unprocessed)
+        return await conn.fetchrow(
+            create_content, hash, file_ref, unprocessed, mime_type
+        )
 
 
 async def _insert_file(content_id: UUID, account_id: UUID, name: str):
@@ -130,35 +212,54 @@ async def _insert_file(content_id: UUID, account_id: UUID, name: str):
         )
 
 
-def _get_remaining_fs_size():
-    os.makedirs(f"{os.getcwd()}/files", exist_ok=True)
-    _, _, free = shutil.disk_usage(f"{os.getcwd()}/files")
+def get_remaining_fs_size():
+    os.makedirs(get_files_dir(), exist_ok=True)
+    _, _, free = shutil.disk_usage(get_files_dir())
     return free
 
 
-async def _handle_file(file: UploadFile):
-    destination, file_ref = generate_file_path()
+# read size when copying uploads
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+# identifiers end with the last 16 bytes of the last 4 KB block, as uploads
+# used to be read in blocks of that size
+IDENTIFIER_BLOCK_SIZE = 4096
+
+
+def _copy_upload(source, destination: str, size: int) -> str:
+    """Writes the upload to destination and returns its identifier. Blocking,
+    the upload is read once, hashing and writing run in the same thread."""
     hash = sha256()
-    first_bytes = None
-    last_bytes = None
+    source.seek(0)
+    with open(destination, "wb") as out_file:
+        while content := source.read(UPLOAD_BUFFER_SIZE):
+            hash.update(content)
+            out_file.write(content)
+    return file_identifier(hash.digest(), source, size)
+
+
+def file_identifier(digest: bytes, source, size: int) -> str:
+    """Identifier of a file from its sha256 digest, its first and last bytes."""
+    source.seek(0)
+    first_bytes = source.read(16)
+    last_block = (size - 1) // IDENTIFIER_BLOCK_SIZE * IDENTIFIER_BLOCK_SIZE
+    source.seek(max(last_block, size - 16))
+    last_bytes = source.read()
+    return base64.b64encode(digest + first_bytes + last_bytes).decode()
+
+
+async def _handle_file(file: UploadFile):
     file_size = file.file.seek(0, 2)
     file.file.seek(0)
-    if file_size > _get_remaining_fs_size() * 3 / 4:
+    if file_size < 1:
+        return "File is empty"
+    if file_size > get_remaining_fs_size() * 3 / 4:
         return "Not enough space"
-    async with aiofiles.open(destination, "wb") as out_file:
-        # async read file chunk
-        while content := await file.read(4096):
-            # Compute for identifying file
-            if not first_bytes:
-                first_bytes = content[:16]
-            last_bytes = content
-            hash.update(content)
-            # async write file chunk
-            await out_file.write(content)
-    if last_bytes is None:
+    destination, file_ref = generate_file_path()
+    try:
+        identifier = await asyncio.to_thread(
+            _copy_upload, file.file, destination, file_size
+        )
+    except Exception:
         remove_files([file_ref])
-        return "File is empty"
-    # create identifying hash
-    last_bytes = last_bytes[-16:]
-    identifier = base64.b64encode(hash.digest() + first_bytes + last_bytes).decode()
+        raise
     return identifier, file_ref
@@ -1,84 +1,148 @@
+import asyncio
 from typing import Iterable
 from uuid import UUID, uuid4
 import magic
 import os
-import imageio
-from PIL import Image
 from app.ai_conversation.db import load_file
 from app.ai_conversation.entities.uploaded_file_content import UploadedFileContent
+from app.ai_conversation.file_handling.file_store import (
+    get_file_path,
+    get_files_dir,
+    iter_files,
+)
+from app.ai_conversation.file_handling.image_optimizer import get_image_optimizer
+from app.ai_conversation.file_handling.processing_registry import (
+    get_processing_registry,
+)
 from app.ai_conversation.file_handling.vectorstore import on_content_deleted
 from more_itertools import chunked
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-get_unreferenced_content = load_file("get_unreferenced_content")
-get_unoptimized_content = load_file("get_unoptimized_content")
+enqueue_unreferenced_content = load_file("enqueue_unreferenced_content")
+enqueue_unoptimized_content = load_file("enqueue_unoptimized_content")
+delete_stale_upload_sessions = load_file("delete_stale_upload_sessions")
 
-currently_processing = {}
+# unfinished uploads are removed after this time without a chunk
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+UNREFERENCED_CONTENT_GRACE_SECONDS = 60
+# GIFs are always converted, JPEG and PNG only if enabled, the conversion is
+# lossy
+CONVERT_IMAGES_TO_WEBP = os.getenv("CONVERT_IMAGES_TO_WEBP", "false").lower() == "true"
+
+# running hash per upload session and the offset it covers, rebuilt from the
+# part file if missing (restart, other instance)
+session_hashes: dict[UUID, tuple] = {}
+session_locks: dict[UUID, asyncio.Lock] = {}
 
 
 def remove_files(ref_list: Iterable[UUID]) -> None:
     for ref in ref_list:
         try:
-            os.remove(f"{os.getcwd()}/files/{ref}")
+            os.remove(get_file_path(ref))
+        except FileNotFoundError:
+            pass
+
+
+def detect_mime_type(path: str) -> str:
+    return magic.from_file(path, mime=True)
+
+
+def get_upload_part_path(upload_id: UUID) -> str:
+    return f"{get_files_dir()}/uploads/{upload_id}.part"
+
+
+def remove_upload_parts(upload_ids: Iterable[UUID]) -> None:
+    for upload_id in upload_ids:
+        session_hashes.pop(upload_id, None)
+        session_locks.pop(upload_id, None)
+        try:
+            os.remove(get_upload_part_path(upload_id))
         except FileNotFoundError:
             pass
 
 
-async def optimize_file_content(
-    async_connection_pool, apscheduler: AsyncIOScheduler
-) -> None:
+async def remove_stale_uploads(async_connection_pool) -> None:
     async with async_connection_pool.acquire() as conn:
-        to_optimize_files = await conn.fetch(
-            get_unoptimized_content, currently_processing.keys()
+        to_delete = await conn.fetch(
+            delete_stale_upload_sessions, UPLOAD_SESSION_TTL_HOURS
         )
-    if to_optimize_files:
-        print(f"Optimizing {len(to_optimize_files)} files")
-    for file in to_optimize_files:
-        await _add_optimize_job(file, apscheduler, async_connection_pool)
-
-
-async def _add_optimize_job(
-    file: dict, apscheduler: AsyncIOScheduler, async_connection_pool
-) -> None:
-    if file["file_ref"] not in currently_processing:
-        currently_processing[file["file_ref"]] = {"vector": False, "optimize": True}
-    apscheduler.add_job(
-        _process_file,
-        "date",
-        args=[UploadedFileContent.load_from_db(file), async_connection_pool],
-        id=str(file["file_ref"]),
-    )
+        # sessions removed by another instance
+        cached = list(set(session_hashes) | set(session_locks))
+        existing = await conn.fetch(
+            "SELECT id FROM upload_session WHERE id IN (SELECT unnest($1::uuid[]));",
+            cached,
+        )
+    if to_delete:
+        print(f"Removing {len(to_delete)} unfinished uploads")
+    remove_upload_parts(map(lambda x: x["id"], to_delete))
+    for upload_id in set(cached) - set(row["id"] for row in existing):
+        session_hashes.pop(upload_id, None)
+        session_locks.pop(upload_id, None)
 
 
-async def remove_unreferenced_content(async_connection_pool):
-    to_delete_files = []
+async def enqueue_file_job(async_connection_pool, kind: str, content_id: UUID) -> None:
     async with async_connection_pool.acquire() as conn:
-        async with conn.transaction():
-            to_delete_files = await conn.fetch(
-                get_unreferenced_content, currently_processing.keys()
-            )
-            if to_delete_files:
-                print(f"Deleting {len(to_delete_files)} file contents")
-            for to_delete in chunked(to_delete_files, 1000):
-                await conn.execute(
-                    "DELETE FROM uploaded_file_content WHERE id IN (SELECT unnest($1::uuid[]));",
-                    list(map(lambda x: x["id"], to_delete)),
-                )
+        await conn.execute(
+            "INSERT INTO file_job(kind, content_id) VALUES ($1, $2) ON CONFLICT DO NOTHING;",
+            kind,
+            content_id,
+        )
+
+
+async def optimize_file_content(async_connection_pool) -> None:
+    """Enqueues contents which were not optimized yet, new contents are
+    enqueued after their import."""
+    async with async_connection_pool.acquire() as conn:
+        await conn.execute(enqueue_unoptimized_content)
+
+
+async def remove_unreferenced_content(async_connection_pool) -> None:
+    """Enqueues contents without files, contents are enqueued by the database
+    when one of their files is deleted."""
+    async with async_connection_pool.acquire() as conn:
+        await conn.execute(
+            enqueue_unreferenced_content,
+            # an upload creates the content before its file
+            UNREFERENCED_CONTENT_GRACE_SECONDS,
+        )
 
+
+async def lock_unreferenced_content(conn, content_id: UUID):
+    """Locks the content until the end of the transaction if it has no files,
+    returns its row. Files added to it meanwhile wait for the transaction."""
+    row = await conn.fetchrow(
+        "SELECT id, file_ref FROM uploaded_file_content WHERE id = $1 FOR UPDATE;",
+        content_id,
+    )
+    # checked once the row is locked, files added before are visible
+    if row is None or await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM uploaded_file WHERE content_id = $1);",
+        content_id,
+    ):
+        return None
+    return row
+
+
+async def remove_content(conn, row) -> None:
+    """Removes the chunks and the stored file of a content locked by
+    lock_unreferenced_content and deletes it. Nothing is left behind if the
+    transaction fails, the row is only gone once it commits."""
     # notify vetorstore of deletions
-    await on_content_deleted(list(map(lambda x: x["id"], to_delete_files)))
+    await on_content_deleted([row["id"]])
+    await conn.execute("DELETE FROM uploaded_file_content WHERE id = $1;", row["id"])
     # delete remaining files from fs
-    remove_files(map(lambda x: x["file_ref"], to_delete_files))
+    remove_files([row["file_ref"]])
 
 
 async def sync_with_db(async_connection_pool):
     files = get_all_files()
+    # files which are being uploaded or optimized may not have a content yet
+    processing = await get_processing_registry().get_processing()
     to_delete_db = []
     async with async_connection_pool.acquire() as conn:
         async with conn.transaction():
             async for record in conn.cursor(
-                "SELECT id, file_ref FROM uploaded_file_content WHERE id NOT IN (SELECT unnest($1::uuid[]));",
-                currently_processing.keys(),
+                "SELECT id, file_ref FROM uploaded_file_content WHERE file_ref NOT IN (SELECT unnest($1::uuid[]));",
+                list(processing),
                 prefetch=1000,
             ):
                 # if file is deleted from fs, delete from db
@@ -90,52 +154,45 @@ async def sync_with_db(async_connection_pool):
 
             for to_delete in chunked(to_delete_db, 1000):
                 await conn.execute(
-                    "DELETE FROM uploaded_file_content WHERE id IN $1;", to_delete
+                    "DELETE FROM uploaded_file_content WHERE id IN (SELECT unnest($1::uuid[]));",
+                    to_delete,
                 )
 
     # notify vetorstore of deletions
     await on_content_deleted(to_delete_db)
-    # delete remaining files from fs
-    remove_files(map(lambda x: x["file_ref"], files))
+    # delete remaining files from fs, except files which are being uploaded
+    remove_files(files - processing)
 
 
 def get_all_files() -> set[UUID]:
-    files = set()
-    dir = f"{os.getcwd()}/files"
-    for f in os.listdir(dir):
-        if not os.path.isfile(f"{dir}/f"):
-            continue
-        try:
-            files.add(UUID(f))
-        except ValueError:
-            continue
-    return files
+    return set(iter_files())
 
 
 def generate_file_path() -> tuple[str, UUID]:
     while True:
         uuid = uuid4()
-        path = f"{os.getcwd()}/files/{uuid}"
+        path = get_file_path(uuid)
         if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
             return path, uuid
 
 
-async def finish_processing(file_ref: UUID) -> None:
-    obj = currently_processing[file_ref]
-    if obj["vector"] or obj["optimize"]:
-        return
-    del currently_processing[file_ref]
-
-
 async def _process_file(file: UploadedFileContent, async_connection_pool) -> None:
-    path = f"{os.getcwd()}/files/{file.file_ref}"
-    type = magic.from_file(path, mime=True)
+    path = get_file_path(file.file_ref)
+    type = file.mime_type or await asyncio.to_thread(detect_mime_type, path)
     uuid = file.file_ref
     match type:
-        case "image/gif":
-            uuid = _gif_to_webp(path)
-        case "image/jpeg", "image/png":
-            uuid = _img_to_webp(path)
+        case "image/gif" | "image/jpeg" | "image/png" if (
+            type == "image/gif" or CONVERT_IMAGES_TO_WEBP
+        ):
+            # converted in a worker process, keeps the event loop free
+            output_path, uuid = generate_file_path()
+            try:
+                await get_image_optimizer().to_webp(type, path, output_path)
+            except Exception:
+                remove_files([uuid])
+                raise
+            type = "image/webp"
         case "application/zip":
             # what to do with zip files? -> extract and process each file
             pass
@@ -144,52 +201,14 @@ async def _process_file(file: UploadedFileContent, async_connection_pool) -> Non
 
     async with async_connection_pool.acquire() as conn:
         status = await conn.execute(
-            "UPDATE uploaded_file_content SET file_ref = $1, unprocessed = false WHERE id = $2;",
+            "UPDATE uploaded_file_content SET file_ref = $1, unprocessed = false, mime_type = $2 WHERE id = $3;",
             uuid,
+            type,
             file.id,
         )
-        if status != "UPDATE 1":
-            raise Exception("Failed to update file_ref")
+    if status != "UPDATE 1":
+        if uuid != file.file_ref:
+            remove_files([uuid])
+        raise Exception("Failed to update file_ref")
     if uuid != file.file_ref:
         os.remove(path)
-    currently_processing[file.file_ref]["optimize"] = False
-    await finish_processing(file.file_ref)
-
-
-def _img_to_webp(input_path: str) -> UUID:
-    output_path, uuid = generate_file_path()
-    img = Image.open(input_path)
-    img.save(output_path, "WEBP", optimize=True, quality=80)
-    return output_path, uuid
-
-
-def _gif_to_webp(input_path: str) -> UUID:
-    output_path, uuid = generate_file_path()
-    gif = Image.open(input_path)
-    # 0 means loop forever
-    loop_count = gif.info.get("loop", 0)
-    # extract durations from frames
-    durations = []
-    while True:
-        # default is 100ms
-        duration = gif.info.get("duration", 100)
-        durations.append(duration)
-        try:
-            gif.seek(gif.tell() + 1)
-        except EOFError:
-            break
-
-    # Read the animated GIF frames using imageio
-    gif_frames = imageio.mimread(input_path)
-    frames = [Image.fromarray(frame) for frame in gif_frames]
-    frames[0].save(
-        output_path,
-        format="WEBP",
-        save_all=True,
-        append_images=frames[1:],
-        duration=durations,
-        loop=loop_count,
-        optimize=True,
-        quality=80,
-    )
-    return output_path, uuid
@@ -0,0 +1,104 @@
+import os
+from PIL import Image
+from app.ai_conversation.file_handling.parsing import DocumentParser
+
+# this module is imported by the worker processes, keep its imports light
+
+WEBP_QUALITY = 80
+# used by browsers for frames without a delay
+DEFAULT_FRAME_DURATION = 100
+
+
+def _color_table_size(flags: int) -> int:
+    return 3 << ((flags & 0x07) + 1) if flags & 0x80 else 0
+
+
+def _skip_sub_blocks(f) -> None:
+    while size := f.read(1)[0]:
+        f.seek(size, os.SEEK_CUR)
+
+
+def gif_durations(path: str) -> list[int]:
+    """Returns the duration of every frame in ms. Only the block headers are
+    read, frames are not decoded."""
+    durations = []
+    delay = None
+    with open(path, "rb") as f:
+        header = f.read(13)
+        if len(header) < 13:
+            return durations
+        f.seek(_color_table_size(header[10]), os.SEEK_CUR)
+        try:
+            while block := f.read(1):
+                match block[0]:
+                    case 0x21:  # extension
+                        if f.read(1) == b"\xf9":  # graphic control
+                            data = f.read(f.read(1)[0])
+                            if len(data) >= 3:
+                                delay = int.from_bytes(data[1:3], "little") * 10
+                        _skip_sub_blocks(f)
+                    case 0x2C:  # image
+                        descriptor = f.read(9)
+                        f.seek(_color_table_size(descriptor[8]) + 1, os.SEEK_CUR)
+                        _skip_sub_blocks(f)
+                        durations.append(
+                            DEFAULT_FRAME_DURATION if delay is None else delay
+                        )
+                        delay = None
+                    case _:  # trailer or garbage
+                        break
+        except IndexError:  # truncated file
+            pass
+    return durations
+
+
+def _gif_to_webp(input_path: str, output_path: str) -> None:
+    durations = gif_durations(input_path)
+    with Image.open(input_path) as gif:
+        # counting frames skips their data, like gif_durations
+        frames = gif.n_frames
+        durations = (durations + [DEFAULT_FRAME_DURATION] * frames)[:frames]
+        # the encoder seeks through the gif, only the current frame is
+        # decoded at a time
+        gif.save(
+            output_path,
+            format="WEBP",
+            save_all=True,
+            duration=durations,
+            # 0 means loop forever
+            loop=gif.info.get("loop", 0),
+            quality=WEBP_QUALITY,
+        )
+
+
+def _img_to_webp(input_path: str, output_path: str) -> None:
+    with Image.open(input_path) as img:
+        img.save(output_path, "WEBP", optimize=True, quality=WEBP_QUALITY)
+
+
+def to_webp(mime_type: str, input_path: str, output_path: str) -> None:
+    if mime_type == "image/gif":
+        _gif_to_webp(input_path, output_path)
+    else:
+        _img_to_webp(input_path, output_path)
+
+
+class ImageOptimizer(DocumentParser):
+    """Converts images to WebP in worker processes, with the timeout and
+    memory limit of the DocumentParser."""
+
+    async def to_webp(self, mime_type: str, input_path: str, output_path: str) -> None:
+        await self.run(to_webp, mime_type, input_path, output_path)
+
+
+image_optimizer: ImageOptimizer = None
+
+
+def set_image_optimizer(optimizer: ImageOptimizer):
+    global image_optimizer
+    image_optimizer = optimizer
+
+
+def get_image_optimizer() -> ImageOptimizer:
+    global image_optimizer
+    return image_optimizer
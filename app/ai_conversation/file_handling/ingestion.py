@@ -0,0 +1,272 @@
+import asyncio
+import traceback
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable
+from uuid import UUID
+from langchain_core.documents import Document
+from app.ai_conversation.entities.uploaded_file_content import UploadedFileContent
+from app.ai_conversation.file_handling.file_store import get_file_path
+from app.ai_conversation.file_handling.streaming import open_document_stream
+from app.ai_conversation.file_handling.vectorstore import (
+    embed_new_documents,
+    get_write_batch_size,
+    load_documents,
+    on_content_deleted,
+    prepare_chunks,
+    upsert_documents,
+    with_retries,
+)
+
+# finished jobs are kept for status requests, oldest are dropped first
+MAX_FINISHED_STATUS = 10_000
+
+
+@dataclass(eq=False)
+class IngestionJob:
+    content: UploadedFileContent
+    on_done: Callable[[str | bool], Awaitable[None]]
+    chunks: int = 0
+    written: int = 0
+    # all chunks are queued, chunks is final
+    loaded: bool = False
+    failed: bool = False
+
+
+# embedding is None if it still has to be computed
+Batch = list[tuple[IngestionJob, Document, list[float] | None]]
+
+
+class IngestionPipeline:
+    """Imports uploaded contents into the vectorstore in the background.
+
+    Stages: load & split -> batch & embed -> write, connected by bounded
+    queues, so a slow stage holds the previous one back instead of buffering
+    documents. Batches mix chunks of different files, a failed batch is
+    retried on its own.
+    """
+
+    def __init__(
+        self, loaders: int = 2, queue_size: int = 4, batch_wait_ms: float = 200
+    ):
+        self.loaders = loaders
+        self.batch_wait = batch_wait_ms / 1000
+        self.load_queue: asyncio.Queue[IngestionJob] = asyncio.Queue()
+        self.chunk_queue: asyncio.Queue[tuple] = None
+        self.write_queue: asyncio.Queue[list[tuple]] = asyncio.Queue(queue_size)
+        self.queue_size = queue_size
+        self.status: OrderedDict[UUID, dict] = OrderedDict()
+        self.workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self.batch_size = get_write_batch_size()
+        self.chunk_queue = asyncio.Queue(self.batch_size * self.queue_size)
+        self.workers = [
+            *[asyncio.create_task(self._load_worker()) for _ in range(self.loaders)],
+            asyncio.create_task(self._embed_worker()),
+            asyncio.create_task(self._write_worker()),
+        ]
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(
+        self,
+        content: UploadedFileContent,
+        on_done: Callable[[str | bool], Awaitable[None]],
+    ) -> dict:
+        self._set_status(content.id, "queued")
+        self.load_queue.put_nowait(IngestionJob(content, on_done))
+        return self.get_status(content.id)
+
+    def get_status(self, content_id: UUID) -> dict | None:
+        status = self.status.get(content_id)
+        return dict(status) if status else None
+
+    def _set_status(self, content_id: UUID, state: str, **kwargs) -> None:
+        status = self.status.setdefault(content_id, {})
+        status["state"] = state
+        status.update(kwargs)
+        if state in ["done", "failed"]:
+            self.status.move_to_end(content_id)
+            while len(self.status) > MAX_FINISHED_STATUS:
+                oldest = next(iter(self.status))
+                if self.status[oldest]["state"] not in ["done", "failed"]:
+                    break
+                del self.status[oldest]
+
+    async def _finish(self, job: IngestionJob, result: str | bool) -> None:
+        if result is True:
+            self._set_status(job.content.id, "done", written=job.written)
+        elif result != "Failed":
+            # e.g. "Not supported", there is nothing to index and the content
+            # is marked indexed
+            self._set_status(job.content.id, "done", written=0, result=result)
+        else:
+            job.failed = True
+            self._set_status(job.content.id, "failed", result=result)
+        try:
+            await job.on_done(result)
+        except Exception:
+            print(traceback.format_exc())
+
+    async def _fail(self, jobs: Iterable[IngestionJob]) -> None:
+        jobs = [job for job in jobs if not job.failed]
+        for job in jobs:
+            await self._finish(job, "Failed")
+        # remove chunks of these files that were already written
+        try:
+            await on_content_deleted([job.content.id for job in jobs])
+        except Exception:
+            print(traceback.format_exc())
+
+    async def _load_worker(self) -> None:
+        while True:
+            job = await self.load_queue.get()
+            self._set_status(job.content.id, "loading")
+            path = get_file_path(job.content.file_ref)
+            try:
+                stream = await asyncio.to_thread(open_document_stream, job.content, path)
+                if stream is not None:
+                    await self._stream_documents(job, stream)
+                    continue
+                loaded = await load_documents(job.content, path)
+            except Exception:
+                print(traceback.format_exc())
+                await self._fail([job])
+                continue
+            if isinstance(loaded, str):
+                await self._finish(job, loaded)
+                continue
+            _, docs, embeddings = loaded
+            if not docs:
+                await self._finish(job, True)
+                continue
+            prepare_chunks(docs)
+            job.chunks = len(docs)
+            job.loaded = True
+            self._set_status(job.content.id, "embedding", chunks=job.chunks)
+            for doc, embedding in zip(docs, embeddings or [None] * len(docs)):
+                if job.failed:
+                    break
+                await self.chunk_queue.put((job, doc, embedding))
+
+    async def _stream_documents(self, job: IngestionJob, stream) -> None:
+        """Queues chunks while the file is still being read, the bounded chunk
+        queue keeps the reader from getting ahead of the embedder."""
+        try:
+            while not job.failed:
+                docs = await asyncio.to_thread(next, stream, None)
+                if docs is None:
+                    break
+                prepare_chunks(docs, job.chunks)
+                job.chunks += len(docs)
+                self._set_status(job.content.id, "embedding", chunks=job.chunks)
+                for doc in docs:
+                    await self.chunk_queue.put((job, doc, None))
+        finally:
+            await asyncio.to_thread(stream.close)
+        if job.failed:
+            return
+        job.loaded = True
+        if job.written >= job.chunks:
+            await self._finish(job, True)
+
+    async def _next_batch(self) -> Batch:
+        loop = asyncio.get_running_loop()
+        batch = [await self.chunk_queue.get()]
+        deadline = loop.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            if not self.chunk_queue.empty():
+                batch.append(self.chunk_queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.chunk_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # chunks of files which failed in an earlier batch are dropped
+        return [item for item in batch if not item[0].failed]
+
+    async def _embed_batch(self, batch: Batch) -> Batch:
+        missing = [item for item in batch if item[2] is None]
+        if not missing:
+            return batch
+        # chunks which are already stored stay None and are only referenced
+        embeddings = iter(await embed_new_documents([doc for _, doc, _ in missing]))
+        return [
+            (job, doc, next(embeddings) if e is None else e) for job, doc, e in batch
+        ]
+
+    async def _write_batch(self, batch: list[tuple]) -> list[tuple]:
+        await upsert_documents(
+            [doc for _, doc, _ in batch], [embedding for _, _, embedding in batch]
+        )
+        return batch
+
+    async def _isolate_failures(self, func, batch: list[tuple]) -> list[tuple]:
+        """Runs func on the batch. If it keeps failing, every file in the batch
+        is retried on its own, so one broken file does not fail the others."""
+        try:
+            return await with_retries(func, batch)
+        except Exception:
+            print(traceback.format_exc())
+        by_job: dict[IngestionJob, list[tuple]] = {}
+        for item in batch:
+            by_job.setdefault(item[0], []).append(item)
+        if len(by_job) < 2:
+            await self._fail(by_job.keys())
+            return []
+        result = []
+        for job, items in by_job.items():
+            try:
+                result.extend(await with_retries(func, items))
+            except Exception:
+                print(traceback.format_exc())
+                await self._fail([job])
+        return result
+
+    async def _embed_worker(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            batch = await self._isolate_failures(self._embed_batch, batch)
+            if batch:
+                await self.write_queue.put(batch)
+
+    async def _write_worker(self) -> None:
+        while True:
+            batch = await self.write_queue.get()
+            # a file may have failed while this batch was waiting
+            batch = [item for item in batch if not item[0].failed]
+            if not batch:
+                continue
+            batch = await self._isolate_failures(self._write_batch, batch)
+            for job, _, _ in batch:
+                job.written += 1
+            for job in set(job for job, _, _ in batch):
+                if job.failed:
+                    continue
+                if job.loaded and job.written >= job.chunks:
+                    await self._finish(job, True)
+                else:
+                    self._set_status(job.content.id, "writing", written=job.written)
+
+
+ingestion_pipeline: IngestionPipeline = None
+
+
+def set_ingestion_pipeline(pipeline: IngestionPipeline):
+    global ingestion_pipeline
+    ingestion_pipeline = pipeline
+
+
+def get_ingestion_pipeline() -> IngestionPipeline:
+    global ingestion_pipeline
+    return ingestion_pipeline
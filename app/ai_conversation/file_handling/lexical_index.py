@@ -0,0 +1,148 @@
+import os
+import re
+import unicodedata
+from collections import Counter
+from uuid import UUID
+from app.ai_conversation.db import load_file
+
+search_lexical_index = load_file("search_lexical_index")
+release_lexical_content = load_file("release_lexical_content")
+recount_lexical_content = load_file("recount_lexical_content")
+
+TERM_PATTERN = re.compile(r"\w+")
+# longer tokens (hashes, base64) are not searched for
+MAX_TERM_LENGTH = 64
+BM25_K1 = 1.2
+BM25_B = 0.75
+# terms in more than about a third of the searched chunks (articles,
+# pronouns) score below this and are skipped, there is no stopword list for
+# the many languages of the files
+LEXICAL_MIN_IDF = float(os.getenv("LEXICAL_MIN_IDF", "1.0"))
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased words, without stemming, the files are in many languages.
+    Course codes and formulas keep their digits and parts."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return [t for t in TERM_PATTERN.findall(text) if len(t) <= MAX_TERM_LENGTH]
+
+
+class LexicalIndex:
+    """BM25 index of the vectorstore chunks in Postgres.
+
+    Chunks are keyed by their vectorstore id and indexed once, the references
+    in chunk_ref select the chunks of the searched contents. The index is
+    written in the transactions of ChunkRefs while the chunks are locked. The
+    chunk count and length per content are kept in lexical_content for the
+    BM25 statistics.
+    """
+
+    def __init__(self, async_connection_pool):
+        self.pool = async_connection_pool
+
+    async def add(self, conn, texts: dict[str, str], refs: list) -> None:
+        """Indexes the chunks which are not indexed yet and counts the added
+        references, rows of (content_id, chunk_id) of chunks in texts."""
+        terms = {id: Counter(tokenize(texts[id])) for id in sorted(texts)}
+        if not terms:
+            return
+        rows = await conn.fetch(
+            """INSERT INTO lexical_chunk(id, length)
+                 SELECT * FROM unnest($1::varchar[], $2::int[])
+                 ON CONFLICT DO NOTHING
+                 RETURNING id;""",
+            list(terms),
+            [sum(counts.values()) for counts in terms.values()],
+        )
+        postings = [
+            (row["id"], term, tf) for row in rows for term, tf in terms[row["id"]].items()
+        ]
+        if postings:
+            await conn.execute(
+                """INSERT INTO lexical_posting(chunk_id, term, tf)
+                     SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::int[]);""",
+                *map(list, zip(*postings)),
+            )
+        stats: dict[UUID, list[int]] = {}
+        for row in refs:
+            counts = stats.setdefault(row["content_id"], [0, 0])
+            counts[0] += 1
+            counts[1] += sum(terms[row["chunk_id"]].values())
+        if stats:
+            values = [(id, *stats[id]) for id in sorted(stats)]
+            await conn.execute(
+                """INSERT INTO lexical_content(content_id, chunks, length)
+                     SELECT * FROM unnest($1::uuid[], $2::int[], $3::bigint[])
+                     ON CONFLICT (content_id) DO UPDATE
+                       SET chunks = lexical_content.chunks + EXCLUDED.chunks,
+                           length = lexical_content.length + EXCLUDED.length;""",
+                *map(list, zip(*values)),
+            )
+
+    async def release(self, conn, refs: list) -> None:
+        """Removes released references, rows of (content_id, chunk_id), from
+        the statistics."""
+        if refs:
+            await conn.execute(
+                release_lexical_content,
+                [row["content_id"] for row in refs],
+                [row["chunk_id"] for row in refs],
+            )
+
+    async def delete(self, conn, ids: list[str]) -> None:
+        """Removes chunks which were deleted from the vectorstore."""
+        if ids:
+            await conn.execute(
+                "DELETE FROM lexical_chunk WHERE id = ANY($1::varchar[]);", ids
+            )
+
+    async def recount(self, content_id: UUID) -> None:
+        """Counts all references of the content in its statistics, references
+        added before their chunk was indexed were not counted."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """INSERT INTO lexical_content(content_id, chunks, length)
+                         SELECT id, 0, 0 FROM uploaded_file_content WHERE id = $1
+                         ON CONFLICT DO NOTHING;""",
+                    content_id,
+                )
+                # writers of the content's references update the row, they
+                # finished or wait for this transaction
+                await conn.execute(
+                    "SELECT 1 FROM lexical_content WHERE content_id = $1 FOR UPDATE;",
+                    content_id,
+                )
+                await conn.execute(recount_lexical_content, content_id)
+
+    async def search(
+        self, query: str, ref_ids: list[UUID | str], limit: int
+    ) -> list[tuple[str, float]]:
+        """Returns (chunk id, score) of the best matches in the contents."""
+        terms = list(set(tokenize(query)))
+        if not terms or not ref_ids:
+            return []
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                search_lexical_index,
+                [UUID(str(ref_id)) for ref_id in ref_ids],
+                terms,
+                BM25_K1,
+                BM25_B,
+                limit,
+                LEXICAL_MIN_IDF,
+            )
+        return [(row["chunk_id"], row["score"]) for row in rows]
+
+
+lexical_index: LexicalIndex = None
+
+
+def set_lexical_index(index: LexicalIndex):
+    global lexical_index
+    lexical_index = index
+
+
+def get_lexical_index() -> LexicalIndex:
+    global lexical_index
+    return lexical_index
@@ -0,0 +1,97 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# this module is imported by the worker processes, keep its imports light
+
+
+def _limit_memory(memory_limit_mb: int) -> None:
+    if memory_limit_mb <= 0:
+        return
+    try:
+        import resource
+    except ImportError:  # not available on every platform
+        return
+    limit = memory_limit_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _parse(loader_class, path: str) -> list:
+    return loader_class(path).load()
+
+
+class DocumentParser:
+    """Runs CPU heavy document loaders in worker processes.
+
+    Every job has a timeout, workers have an address space limit. A job that
+    times out kills the pool, which is replaced immediately; jobs that were
+    running on the old pool are retried once.
+    """
+
+    def __init__(self, workers: int = 2, timeout: float = 300, memory_limit_mb: int = 0):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        # the timeout should only count while a job is running
+        self._slots = asyncio.Semaphore(workers)
+        self._pool = self._create_pool()
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            # forking a process with loaded models and threads is not safe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_limit_memory,
+            initargs=(self.memory_limit_mb,),
+        )
+
+    def _kill(self, pool: ProcessPoolExecutor) -> None:
+        # shutdown does not stop running jobs
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _replace_pool(self, pool: ProcessPoolExecutor) -> None:
+        if self._pool is not pool:
+            return
+        self._pool = self._create_pool()
+        self._kill(pool)
+
+    async def run(self, func, *args, retry: bool = True):
+        """Runs func(*args) in a worker, func and args must be picklable."""
+        async with self._slots:
+            pool = self._pool
+            future = pool.submit(func, *args)
+            try:
+                return await asyncio.wait_for(
+                    asyncio.wrap_future(future), self.timeout
+                )
+            except asyncio.TimeoutError:
+                self._replace_pool(pool)
+                raise TimeoutError(f"Job took longer than {self.timeout}s")
+            except BrokenProcessPool:
+                # killed because of another job or hit the memory limit
+                self._replace_pool(pool)
+                if not retry:
+                    raise
+        return await self.run(func, *args, retry=False)
+
+    async def parse(self, loader_class, path: str) -> list:
+        return await self.run(_parse, loader_class, path)
+
+    def shutdown(self) -> None:
+        self._kill(self._pool)
+
+
+document_parser: DocumentParser = None
+
+
+def set_document_parser(parser: DocumentParser):
+    global document_parser
+    document_parser = parser
+
+
+def get_document_parser() -> DocumentParser:
+    global document_parser
+    return document_parser
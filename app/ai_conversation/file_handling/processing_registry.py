@@ -0,0 +1,106 @@
+import asyncio
+import os
+import socket
+import traceback
+from uuid import UUID, uuid4
+from app.ai_conversation.db import load_file
+
+acquire_processing_lease = load_file("acquire_processing_lease")
+
+# a lease expires if its instance stops renewing it for this long
+PROCESSING_LEASE_SECONDS = int(os.getenv("PROCESSING_LEASE_SECONDS", "120"))
+
+
+class ProcessingRegistry:
+    """Tracks which file_refs are being imported, re-indexed or optimized.
+
+    A file_ref is held by at most one task of one instance at a time. Leases
+    are stored in the processing_lease table, so every replica sees them, and
+    are renewed by a heartbeat while this instance runs. Leases of a crashed
+    instance expire after PROCESSING_LEASE_SECONDS.
+    """
+
+    def __init__(self, async_connection_pool, lease_seconds: int = PROCESSING_LEASE_SECONDS):
+        self.pool = async_connection_pool
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.held: dict[UUID, str] = {}
+        self._heartbeat_task: asyncio.Task = None
+
+    async def start(self) -> None:
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM processing_lease WHERE owner = $1;", self.owner)
+        self.held.clear()
+
+    async def acquire(self, file_ref: UUID, task: str) -> bool:
+        """Takes the lease on file_ref, False if another task holds it."""
+        async with self.pool.acquire() as conn:
+            acquired = await conn.fetchval(
+                acquire_processing_lease,
+                file_ref,
+                task,
+                self.owner,
+                float(self.lease_seconds),
+            )
+        if acquired is None:
+            return False
+        self.held[file_ref] = task
+        return True
+
+    async def release(self, file_ref: UUID) -> None:
+        self.held.pop(file_ref, None)
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM processing_lease WHERE file_ref = $1 AND owner = $2;",
+                file_ref,
+                self.owner,
+            )
+
+    async def is_processing(self, file_ref: UUID) -> bool:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM processing_lease WHERE file_ref = $1 AND expires_at > NOW());",
+                file_ref,
+            )
+
+    async def get_processing(self) -> set[UUID]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT file_ref FROM processing_lease WHERE expires_at > NOW();"
+            )
+        return {row["file_ref"] for row in rows}
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not self.held:
+                continue
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.execute(
+                        "UPDATE processing_lease SET expires_at = NOW() + make_interval(secs => $2) WHERE owner = $1;",
+                        self.owner,
+                        float(self.lease_seconds),
+                    )
+            except Exception:
+                print(traceback.format_exc())
+
+
+processing_registry: ProcessingRegistry = None
+
+
+def set_processing_registry(registry: ProcessingRegistry):
+    global processing_registry
+    processing_registry = registry
+
+
+def get_processing_registry() -> ProcessingRegistry:
+    global processing_registry
+    return processing_registry
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import traceback
+from uuid import UUID
+from app.ai_conversation.db import load_file
+from app.ai_conversation.entities.uploaded_file_content import UploadedFileContent
+from app.ai_conversation.file_handling.file_store import get_file_path
+from app.ai_conversation.file_handling.processing_registry import (
+    get_processing_registry,
+)
+from app.ai_conversation.file_handling.streaming import open_document_stream
+from app.ai_conversation.file_handling.vectorstore import (
+    get_chunk_ids,
+    get_index_version,
+    load_documents,
+    prepare_chunks,
+    release_chunks,
+    write_documents,
+)
+
+get_stale_content = load_file("get_stale_content")
+
+# contents re-indexed per scheduler run
+REINDEX_BATCH_SIZE = int(os.getenv("REINDEX_BATCH_SIZE", "5"))
+# failed attempts after which a content is left until the index version changes
+REINDEX_MAX_ATTEMPTS = int(os.getenv("REINDEX_MAX_ATTEMPTS", "3"))
+
+
+async def mark_indexed(async_connection_pool, content_id: UUID, indexed: bool) -> None:
+    async with async_connection_pool.acquire() as conn:
+        if indexed:
+            await conn.execute(
+                """UPDATE uploaded_file_content
+                     SET index_version = $1, index_attempts = 0, failed_index_version = NULL
+                     WHERE id = $2;""",
+                get_index_version(),
+                content_id,
+            )
+        else:
+            # also touches updated_at, so other stale contents are tried first
+            await conn.execute(
+                """UPDATE uploaded_file_content
+                     SET index_attempts = CASE WHEN failed_index_version = $1
+                           THEN index_attempts + 1 ELSE 1 END,
+                         failed_index_version = $1
+                     WHERE id = $2;""",
+                get_index_version(),
+                content_id,
+            )
+
+
+async def _load_chunks(content: UploadedFileContent, path: str):
+    stream = await asyncio.to_thread(open_document_stream, content, path)
+    if stream is None:
+        loaded = await load_documents(content, path)
+        if not isinstance(loaded, str):
+            yield loaded[1], loaded[2]
+        return
+    try:
+        while (docs := await asyncio.to_thread(next, stream, None)) is not None:
+            yield docs, None
+    finally:
+        await asyncio.to_thread(stream.close)
+
+
+async def _reindex(content: UploadedFileContent) -> None:
+    old_ids = set(await asyncio.to_thread(get_chunk_ids, content.id))
+    new_ids = set()
+    seq = 0
+    try:
+        async for docs, embeddings in _load_chunks(
+            content, get_file_path(content.file_ref)
+        ):
+            prepare_chunks(docs, seq)
+            seq += len(docs)
+            new_ids.update(doc.metadata["id"] for doc in docs)
+            await write_documents(docs, embeddings)
+    except Exception:
+        await release_chunks([content.id], list(new_ids - old_ids))
+        raise
+    # old chunks are only released once the new ones are written
+    await release_chunks([content.id], list(old_ids - new_ids))
+
+
+async def reindex_stale_content(async_connection_pool) -> None:
+    async with async_connection_pool.acquire() as conn:
+        to_reindex = await conn.fetch(
+            get_stale_content,
+            get_index_version(),
+            REINDEX_BATCH_SIZE,
+            REINDEX_MAX_ATTEMPTS,
+        )
+    if to_reindex:
+        print(f"Re-indexing {len(to_reindex)} file contents")
+    registry = get_processing_registry()
+    for row in to_reindex:
+        content = UploadedFileContent.load_from_db(row)
+        if not await registry.acquire(content.file_ref, "reindex"):
+            continue
+        indexed = False
+        try:
+            await _reindex(content)
+            indexed = True
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            await registry.release(content.file_ref)
+        await mark_indexed(async_connection_pool, content.id, indexed)
@@ -0,0 +1,181 @@
+import asyncio
+import os
+from hashlib import sha256
+from uuid import UUID
+from fastapi import HTTPException, Request
+from app.ai_conversation.ai_conversation import get_connection_pool
+from app.ai_conversation.file_handling.file_upload import (
+    UPLOAD_BUFFER_SIZE,
+    file_identifier,
+    get_remaining_fs_size,
+    register_upload,
+)
+from app.ai_conversation.file_handling.file_upload_processor import (
+    generate_file_path,
+    get_upload_part_path,
+    remove_upload_parts,
+    session_hashes,
+    session_locks,
+)
+
+# largest chunk accepted per request
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE_MB", "8")) * 1024 * 1024
+
+
+def _session_to_dict(row) -> dict:
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "size": row["size"],
+        "offset": row["received"],
+        "chunkSize": UPLOAD_CHUNK_SIZE,
+    }
+
+
+async def _get_session(upload_id: UUID, user_id: UUID):
+    async with get_connection_pool().acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT * FROM upload_session WHERE id = $1 and account_id = $2;",
+            upload_id,
+            user_id,
+        )
+    if not row:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return row
+
+
+async def _lock_session(conn, upload_id: UUID, user_id: UUID):
+    """Locks the session until the end of the transaction, requests for it on
+    other instances wait."""
+    row = await conn.fetchrow(
+        "SELECT * FROM upload_session WHERE id = $1 and account_id = $2 FOR UPDATE;",
+        upload_id,
+        user_id,
+    )
+    if not row:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return row
+
+
+def _running_hash(upload_id: UUID, offset: int):
+    stored = session_hashes.get(upload_id)
+    if stored is not None and stored[0] == offset:
+        return stored[1].copy()
+    hash = sha256()
+    remaining = offset
+    with open(get_upload_part_path(upload_id), "rb") as f:
+        while remaining > 0:
+            content = f.read(min(UPLOAD_BUFFER_SIZE, remaining))
+            if not content:
+                raise HTTPException(status_code=409, detail="Upload data is missing")
+            hash.update(content)
+            remaining -= len(content)
+    return hash
+
+
+def _append(upload_id: UUID, offset: int, content: bytes) -> None:
+    hash = _running_hash(upload_id, offset)
+    with open(get_upload_part_path(upload_id), "r+b") as f:
+        f.seek(offset)
+        f.write(content)
+        # drop the rest of an earlier, interrupted write
+        f.truncate()
+    hash.update(content)
+    session_hashes[upload_id] = (offset + len(content), hash)
+
+
+def _finish(upload_id: UUID, size: int, destination: str) -> str:
+    hash = _running_hash(upload_id, size)
+    path = get_upload_part_path(upload_id)
+    with open(path, "rb") as f:
+        identifier = file_identifier(hash.digest(), f, size)
+    # same file system, the data is not copied
+    os.replace(path, destination)
+    return identifier
+
+
+async def _read_chunk(request: Request) -> bytes:
+    content = bytearray()
+    async for part in request.stream():
+        content += part
+        if len(content) > UPLOAD_CHUNK_SIZE:
+            raise HTTPException(status_code=413, detail="Chunk too large")
+    return bytes(content)
+
+
+async def handle_upload_create(name: str, size: int, user_id: UUID) -> dict:
+    if size < 1:
+        raise HTTPException(status_code=400, detail="File is empty")
+    if size > get_remaining_fs_size() * 3 / 4:
+        raise HTTPException(status_code=507, detail="Not enough space")
+    async with get_connection_pool().acquire() as conn:
+        row = await conn.fetchrow(
+            "INSERT INTO upload_session(account_id, name, size) VALUES ($1, $2, $3) RETURNING *;",
+            user_id,
+            name,
+            size,
+        )
+    path = get_upload_part_path(row["id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    return _session_to_dict(row)
+
+
+async def handle_upload_get(upload_id: UUID, user_id: UUID) -> dict:
+    return _session_to_dict(await _get_session(upload_id, user_id))
+
+
+async def handle_upload_append(
+    upload_id: UUID, user_id: UUID, offset: int, checksum: str, request: Request
+) -> dict:
+    await _get_session(upload_id, user_id)
+    content = await _read_chunk(request)
+    if sha256(content).hexdigest() != checksum.lower():
+        raise HTTPException(status_code=400, detail="Checksum mismatch")
+    # requests on this instance queue here instead of holding connections
+    async with session_locks.setdefault(upload_id, asyncio.Lock()):
+        async with get_connection_pool().acquire() as conn:
+            async with conn.transaction():
+                # the offset is claimed before anything is written, a request
+                # which waited for the lock sees the new offset
+                row = await _lock_session(conn, upload_id, user_id)
+                if offset != row["received"]:
+                    # the client resumes from the returned offset
+                    raise HTTPException(status_code=409, detail=_session_to_dict(row))
+                if offset + len(content) > row["size"]:
+                    raise HTTPException(
+                        status_code=400, detail="Chunk exceeds file size"
+                    )
+                await asyncio.to_thread(_append, upload_id, offset, content)
+                updated = await conn.fetchrow(
+                    "UPDATE upload_session SET received = $1 WHERE id = $2 RETURNING *;",
+                    offset + len(content),
+                    upload_id,
+                )
+    return _session_to_dict(updated)
+
+
+async def handle_upload_finalize(upload_id: UUID, user_id: UUID) -> dict:
+    async with session_locks.setdefault(upload_id, asyncio.Lock()):
+        async with get_connection_pool().acquire() as conn:
+            async with conn.transaction():
+                row = await _lock_session(conn, upload_id, user_id)
+                if row["received"] != row["size"]:
+                    raise HTTPException(status_code=409, detail=_session_to_dict(row))
+                destination, file_ref = generate_file_path()
+                identifier = await asyncio.to_thread(
+                    _finish, upload_id, row["size"], destination
+                )
+                await conn.execute(
+                    "DELETE FROM upload_session WHERE id = $1;", upload_id
+                )
+        remove_upload_parts([upload_id])
+    return await register_upload(identifier, file_ref, row["name"], user_id)
+
+
+async def handle_upload_delete(upload_id: UUID, user_id: UUID) -> None:
+    await _get_session(upload_id, user_id)
+    async with get_connection_pool().acquire() as conn:
+        await conn.execute("DELETE FROM upload_session WHERE id = $1;", upload_id)
+    remove_upload_parts([upload_id])
+
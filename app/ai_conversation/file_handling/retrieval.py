@@ -0,0 +1,266 @@
+import asyncio
+import os
+import traceback
+import numpy as np
+from langchain_core.documents import Document
+from app.ai_conversation.embeddings.executor import get_embedding_executor
+from app.ai_conversation.file_handling.chunk_refs import get_chunk_refs
+from app.ai_conversation.file_handling.lexical_index import get_lexical_index
+from app.ai_conversation.file_handling.vectorstore import (
+    get_chroma,
+    get_chunks,
+    get_documents_by_ids,
+    similarity_search,
+)
+
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "5"))
+RETRIEVAL_SCORE_THRESHOLD = float(os.getenv("RETRIEVAL_SCORE_THRESHOLD", "0.4"))
+# results per search before fusion, and chunks which are reranked
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+LEXICAL_SEARCH = os.getenv("LEXICAL_SEARCH", "true").lower() == "true"
+# minimum BM25 score of chunks the vector search did not find
+LEXICAL_SCORE_THRESHOLD = float(os.getenv("LEXICAL_SCORE_THRESHOLD", "1.5"))
+# 1 ranks by relevance only, lower values prefer chunks unlike the chosen ones
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.5"))
+# neighbouring chunks added on each side of a retrieved chunk
+CONTEXT_WINDOW = int(os.getenv("CONTEXT_WINDOW", "1"))
+# estimated tokens of all chunks in the prompt, neighbours are added until it
+# is reached
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CHARS_PER_TOKEN = 4
+# damps the influence of the top ranks, 60 is the value of the RRF paper
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[str]], k: int = RRF_K
+) -> list[tuple[str, float]]:
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] = scores.get(id, 0) + 1 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+def maximal_marginal_relevance(
+    relevance: np.ndarray, embeddings: np.ndarray, k: int, lambda_mult: float
+) -> list[int]:
+    """Indices of k candidates, each chosen for its relevance minus its
+    similarity to the already chosen ones."""
+    if len(relevance) == 0:
+        return []
+    # relevance (positive) and similarity on the same scale
+    if relevance.max() > 0:
+        relevance = relevance / relevance.max()
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    embeddings = embeddings / norms
+    similarity = embeddings @ embeddings.T
+    selected = []
+    candidates = list(range(len(relevance)))
+    while candidates and len(selected) < k:
+        redundancy = (
+            similarity[np.ix_(candidates, selected)].max(axis=1)
+            if selected
+            else np.zeros(len(candidates))
+        )
+        scores = lambda_mult * relevance[candidates] - (1 - lambda_mult) * redundancy
+        selected.append(candidates.pop(int(np.argmax(scores))))
+    return selected
+
+
+cross_encoder = None
+
+
+def set_cross_encoder(model):
+    global cross_encoder
+    cross_encoder = model
+
+
+def get_cross_encoder():
+    global cross_encoder
+    return cross_encoder
+
+
+async def _vector_search(
+    query: str, content_ids: list[str], k: int
+) -> tuple[list[Document], list[float], list]:
+    query_embedding = await get_chroma().embeddings.aembed_query(query)
+    docs, scores, embeddings = await similarity_search(query_embedding, content_ids, k)
+    keep = [i for i, score in enumerate(scores) if score >= RETRIEVAL_SCORE_THRESHOLD]
+    return (
+        [docs[i] for i in keep],
+        [scores[i] for i in keep],
+        [embeddings[i] for i in keep],
+    )
+
+
+async def _lexical_search(
+    query: str, content_ids: list[str], k: int
+) -> list[tuple[str, float]]:
+    try:
+        return await get_lexical_index().search(query, content_ids, k)
+    except Exception:
+        # the vector results are still useful
+        print(traceback.format_exc())
+        return []
+
+
+async def _cross_encoder_scores(query: str, docs: list[Document]) -> list[float]:
+    # runs on the model inference threads
+    logits = await get_embedding_executor().run(
+        get_cross_encoder().predict,
+        [(query, doc.page_content) for doc in docs],
+        show_progress_bar=False,
+    )
+    # positive, like the fusion scores
+    return list(1 / (1 + np.exp(-np.asarray(logits, dtype=np.float64))))
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+async def expand_context(
+    docs: list[Document], content_ids: list[str]
+) -> list[Document]:
+    """Adds the neighbouring chunks of the documents, best ranked first, as
+    long as CONTEXT_TOKEN_BUDGET allows. Overlapping or adjacent windows of
+    one content are merged into one document."""
+    rows = await get_chunk_refs().get_windows(
+        [doc.metadata["id"] for doc in docs], content_ids, CONTEXT_WINDOW
+    )
+    # position of a retrieved chunk in a content the user can see, a shared
+    # chunk is expanded in one of them
+    positions: dict[str, tuple[str, int]] = {}
+    window_ids: dict[str, dict[int, str]] = {}
+    for row in rows:
+        key = str(row["content_id"])
+        positions[row["hit_id"]] = (key, row["hit_seq"])
+        window_ids.setdefault(key, {})[row["seq"]] = row["chunk_id"]
+    if not positions:
+        return docs
+    texts = {doc.metadata["id"]: doc.page_content for doc in docs}
+    missing = set(id for seqs in window_ids.values() for id in seqs.values())
+    for doc in await get_chunks(list(missing - set(texts))):
+        texts[doc.metadata["id"]] = doc.page_content
+    # chunks deleted since their positions were read are skipped
+    chunks = {
+        key: {seq: texts[id] for seq, id in seqs.items() if id in texts}
+        for key, seqs in window_ids.items()
+    }
+    budget = CONTEXT_TOKEN_BUDGET
+    included = set()
+    for doc in docs:
+        budget -= _estimate_tokens(doc.page_content)
+        if doc.metadata["id"] in positions:
+            included.add(positions[doc.metadata["id"]])
+    # [rank, key, first seq, last seq]
+    windows = []
+    for rank, doc in enumerate(docs):
+        if doc.metadata["id"] not in positions:
+            continue
+        key, seq = positions[doc.metadata["id"]]
+        window = [rank, key, seq, seq]
+        windows.append(window)
+        for _ in range(CONTEXT_WINDOW):
+            for side in (2, 3):
+                seq = window[side] + (-1 if side == 2 else 1)
+                text = chunks[key].get(seq)
+                if text is None:
+                    continue
+                if (key, seq) not in included:
+                    if _estimate_tokens(text) > budget:
+                        continue
+                    budget -= _estimate_tokens(text)
+                    included.add((key, seq))
+                window[side] = seq
+    merged: dict[int, tuple[int, int]] = {}
+    for key in set(window[1] for window in windows):
+        current = None
+        for window in sorted((w for w in windows if w[1] == key), key=lambda w: w[2]):
+            if current is not None and window[2] <= current[3] + 1:
+                current[0] = min(current[0], window[0])
+                current[3] = max(current[3], window[3])
+                continue
+            if current is not None:
+                merged[current[0]] = (current[2], current[3])
+            current = list(window)
+        merged[current[0]] = (current[2], current[3])
+    result = []
+    for rank, doc in enumerate(docs):
+        if doc.metadata["id"] not in positions:
+            result.append(doc)
+        elif rank in merged:
+            key = positions[doc.metadata["id"]][0]
+            first, last = merged[rank]
+            result.append(
+                Document(
+                    page_content="\n".join(
+                        chunks[key][seq] for seq in range(first, last + 1)
+                    ),
+                    # the best ranked chunk is cited
+                    metadata=dict(doc.metadata),
+                )
+            )
+    return result
+
+
+async def retrieve(query: str, content_ids: list[str]) -> list[Document]:
+    """Chunks of the contents matching the query.
+
+    The vector and BM25 searches run concurrently and are merged with
+    reciprocal rank fusion, so exact matches of codes, formulas and names are
+    found even if the embedding misses them. The candidates are optionally
+    rescored with a cross-encoder, near duplicates are dropped with MMR and
+    the neighbours of the chosen chunks are added.
+    """
+    if not content_ids:
+        return []
+    if LEXICAL_SEARCH:
+        (vector_docs, _, vector_embeddings), lexical_hits = await asyncio.gather(
+            _vector_search(query, content_ids, RETRIEVAL_CANDIDATES),
+            _lexical_search(query, content_ids, RETRIEVAL_CANDIDATES),
+        )
+        vector_ids = set(doc.metadata["id"] for doc in vector_docs)
+        # weak BM25 matches are kept only if they are similar enough, too
+        lexical_ids = [
+            id
+            for id, score in lexical_hits
+            if id in vector_ids or score >= LEXICAL_SCORE_THRESHOLD
+        ]
+        ranked = reciprocal_rank_fusion(
+            [[doc.metadata["id"] for doc in vector_docs], lexical_ids]
+        )[:RETRIEVAL_CANDIDATES]
+    else:
+        vector_docs, scores, vector_embeddings = await _vector_search(
+            query, content_ids, RETRIEVAL_CANDIDATES
+        )
+        ranked = [(doc.metadata["id"], score) for doc, score in zip(vector_docs, scores)]
+    docs = {
+        doc.metadata["id"]: (doc, embedding)
+        for doc, embedding in zip(vector_docs, vector_embeddings)
+    }
+    missing = [id for id, _ in ranked if id not in docs]
+    for doc, embedding in zip(*await get_documents_by_ids(missing)):
+        docs[doc.metadata["id"]] = (doc, embedding)
+    # ids of deleted chunks are skipped
+    ranked = [(id, score) for id, score in ranked if id in docs]
+    if not ranked:
+        return []
+    candidates = [docs[id][0] for id, _ in ranked]
+    if get_cross_encoder() is not None:
+        relevance = np.asarray(await _cross_encoder_scores(query, candidates))
+    else:
+        relevance = np.asarray([score for _, score in ranked])
+    if MMR_LAMBDA >= 1:
+        order = np.argsort(-relevance, kind="stable")[:RETRIEVAL_K]
+    else:
+        embeddings = np.asarray([docs[id][1] for id, _ in ranked], dtype=np.float32)
+        order = maximal_marginal_relevance(
+            relevance, embeddings, RETRIEVAL_K, MMR_LAMBDA
+        )
+    selected = [candidates[i] for i in order]
+    if CONTEXT_WINDOW > 0:
+        return await expand_context(selected, content_ids)
+    return selected
@@ -1,6 +1,6 @@
 from typing import List
 from uuid import UUID
-from fastapi import APIRouter, File, Request, UploadFile
+from fastapi import APIRouter, Body, File, Request, UploadFile
 from fastapi.responses import FileResponse
 
 from app.ai_conversation.file_handling.file_upload import (
@@ -9,6 +9,14 @@ from app.ai_conversation.file_handling.file_upload import (
     handle_file_delete,
     handle_file_get,
     handle_file_list,
+    handle_file_status,
+)
+from app.ai_conversation.file_handling.resumable_upload import (
+    handle_upload_append,
+    handle_upload_create,
+    handle_upload_delete,
+    handle_upload_finalize,
+    handle_upload_get,
 )
 from app.security.oauth2 import DEPENDENCIES
 
@@ -23,11 +31,49 @@ async def list_files(request: Request) -> list[dict]:
 async def get_file_info(request: Request, file_id: UUID) -> dict:
     return await handle_file_info(file_id, request.state.user_id)
 
+@router.get("/status/{file_id}", dependencies=DEPENDENCIES, tags=["File"])
+async def get_file_status(request: Request, file_id: UUID) -> dict:
+    return await handle_file_status(file_id, request.state.user_id)
+
+
 @router.post("/upload", dependencies=DEPENDENCIES, tags=["File"])
 async def upload(request: Request, files: List[UploadFile] = File(...)) -> list[dict]:
     return await handle_file_upload(files, request.state.user_id)
 
 
+# resumable uploads: create, append chunks (raw body) in order, finalize
+@router.post("/uploads", dependencies=DEPENDENCIES, tags=["File"])
+async def create_upload(
+    request: Request, name: str = Body(...), size: int = Body(...)
+) -> dict:
+    return await handle_upload_create(name, size, request.state.user_id)
+
+
+@router.get("/uploads/{upload_id}", dependencies=DEPENDENCIES, tags=["File"])
+async def get_upload(request: Request, upload_id: UUID) -> dict:
+    return await handle_upload_get(upload_id, request.state.user_id)
+
+
+@router.put("/uploads/{upload_id}", dependencies=DEPENDENCIES, tags=["File"])
+async def append_upload(
+    request: Request, upload_id: UUID, offset: int, checksum: str
+) -> dict:
+    """Appends the request body at offset, checksum is its hex sha256."""
+    return await handle_upload_append(
+        upload_id, request.state.user_id, offset, checksum, request
+    )
+
+
+@router.post("/uploads/{upload_id}/finalize", dependencies=DEPENDENCIES, tags=["File"])
+async def finalize_upload(request: Request, upload_id: UUID) -> dict:
+    return await handle_upload_finalize(upload_id, request.state.user_id)
+
+
+@router.delete("/uploads/{upload_id}", dependencies=DEPENDENCIES, tags=["File"])
+async def delete_upload(request: Request, upload_id: UUID) -> None:
+    return await handle_upload_delete(upload_id, request.state.user_id)
+
+
 @router.delete("/delete/{file_id}", dependencies=DEPENDENCIES, tags=["File"])
 async def delete(request: Request, file_id: UUID) -> None:
     return await handle_file_delete(file_id, request.state.user_id)
@@ -35,4 +81,6 @@ async def delete(request: Request, file_id: UUID) -> None:
 
 @router.get("/content/{file_id}", dependencies=DEPENDENCIES, tags=["File"])
 async def get_content(request: Request, file_id: UUID) -> FileResponse:
-    return await handle_file_get(file_id, request.state.user_id)
+    return await handle_file_get(
+        file_id, request.state.user_id, request.headers.get("if-none-match")
+    )
@@ -0,0 +1,140 @@
+import asyncio
+import re
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from more_itertools import chunked
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?。！？])\s+|\n\s*\n")
+# sentences per embedding call
+EMBED_BATCH_SIZE = 256
+
+Span = tuple[int, int]
+
+
+class SemanticSplitter:
+    """Splits prose into chunks of consecutive, similar sentences.
+
+    Every sentence is embedded once. A chunk ends where the distance between
+    two neighbouring sentences is above the given percentile of the document,
+    or when the next sentence would not fit into the model's token window.
+    The chunk embedding is the mean of its sentence embeddings, so chunks do
+    not have to be embedded again.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        tokenizer,
+        max_tokens: int,
+        separators: list[str],
+        breakpoint_percentile: float = 95,
+    ):
+        self.embeddings = embeddings
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.breakpoint_percentile = breakpoint_percentile
+        # for sentences longer than the token window
+        self.fallback_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer,
+            separators=separators,
+            chunk_size=max_tokens,
+            chunk_overlap=0,
+        )
+
+    def _token_counts(self, texts: list[str]) -> list[int]:
+        if not texts:
+            return []
+        ids = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return [len(i) for i in ids]
+
+    def _split_sentences(self, text: str) -> tuple[list[Span], list[int]]:
+        spans = []
+        start = 0
+        for match in [*SENTENCE_BOUNDARY.finditer(text), None]:
+            end = match.start() if match else len(text)
+            if text[start:end].strip():
+                spans.append((start, end))
+            if match:
+                start = match.end()
+        counts = self._token_counts([text[s:e] for s, e in spans])
+        result_spans, result_counts = [], []
+        for (start, end), count in zip(spans, counts):
+            if count <= self.max_tokens:
+                result_spans.append((start, end))
+                result_counts.append(count)
+                continue
+            offset = start
+            parts = self.fallback_splitter.split_text(text[start:end])
+            for part, part_count in zip(parts, self._token_counts(parts)):
+                offset = text.index(part, offset)
+                result_spans.append((offset, offset + len(part)))
+                result_counts.append(part_count)
+                offset += len(part)
+        return result_spans, result_counts
+
+    def _group(self, vectors: np.ndarray, counts: list[int]) -> list[list[int]]:
+        if len(counts) < 2:
+            return [list(range(len(counts)))]
+        distances = 1 - np.sum(vectors[:-1] * vectors[1:], axis=1)
+        threshold = np.percentile(distances, self.breakpoint_percentile)
+        groups = [[0]]
+        tokens = counts[0]
+        for i in range(1, len(counts)):
+            if distances[i - 1] > threshold or tokens + counts[i] > self.max_tokens:
+                groups.append([i])
+                tokens = counts[i]
+            else:
+                groups[-1].append(i)
+                tokens += counts[i]
+        return groups
+
+    async def split_documents(
+        self, docs: list[Document]
+    ) -> tuple[list[Document], list[list[float]]]:
+        """Returns the chunks and their embeddings."""
+        splits = await asyncio.to_thread(
+            lambda: [self._split_sentences(doc.page_content) for doc in docs]
+        )
+        sentences = [
+            doc.page_content[s:e] for doc, (spans, _) in zip(docs, splits) for s, e in spans
+        ]
+        vectors = []
+        for batch in chunked(sentences, EMBED_BATCH_SIZE):
+            vectors.extend(await self.embeddings.aembed_documents(list(batch)))
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(sentences), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors = vectors / norms
+        chunks, embeddings = [], []
+        offset = 0
+        for doc, (spans, counts) in zip(docs, splits):
+            doc_vectors = vectors[offset : offset + len(spans)]
+            offset += len(spans)
+            if not spans:
+                continue
+            for group in self._group(doc_vectors, counts):
+                start, end = spans[group[0]][0], spans[group[-1]][1]
+                chunks.append(
+                    Document(
+                        page_content=doc.page_content[start:end],
+                        metadata=dict(doc.metadata),
+                    )
+                )
+                mean = doc_vectors[group].mean(axis=0)
+                embeddings.append((mean / (np.linalg.norm(mean) or 1)).tolist())
+        return chunks, embeddings
+
+
+semantic_splitter: SemanticSplitter = None
+
+
+def set_semantic_splitter(splitter: SemanticSplitter):
+    global semantic_splitter
+    semantic_splitter = splitter
+
+
+def get_semantic_splitter() -> SemanticSplitter:
+    global semantic_splitter
+    return semantic_splitter
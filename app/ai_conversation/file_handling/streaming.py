@@ -0,0 +1,122 @@
+import csv
+import os
+from typing import Iterator
+import magic
+from langchain_core.documents import Document
+from langchain_text_splitters import Language, RecursiveCharacterTextSplitter
+from app.ai_conversation.entities.uploaded_file_content import UploadedFileContent
+from app.ai_conversation.file_handling.vectorstore import (
+    get_css_splitter,
+    get_json_splitter,
+    get_splitter_for_language,
+    standard_text_splitter,
+)
+
+# text files above this size are split while reading instead of loaded at once
+STREAMING_THRESHOLD = int(os.getenv("STREAMING_THRESHOLD_MB", "8")) * 1024 * 1024
+# characters read per block
+STREAMING_BUFFER_SIZE = 1024 * 1024
+# csv rows per block
+STREAMING_CSV_ROWS = 1000
+
+
+def _get_streaming_splitter(mime_type: str) -> RecursiveCharacterTextSplitter | None:
+    # same splitters as load_documents
+    match mime_type:
+        case "text/plain" | "application/x-sh" | "application/x-csh":
+            return standard_text_splitter
+        case "text/css":
+            return get_css_splitter()
+        case "text/javascript":
+            return get_splitter_for_language(Language.JS)
+        case "application/json" | "application/ld+json":
+            return get_json_splitter()
+        case "application/x-latex" | "application/x-tex":
+            return get_splitter_for_language(Language.LATEX)
+        case "application/x-httpd-php":
+            return get_splitter_for_language(Language.PHP)
+    return None
+
+
+def iter_split_text(
+    path: str, splitter: RecursiveCharacterTextSplitter
+) -> Iterator[list[str]]:
+    """Splits a text file block by block.
+
+    The last chunk of every block is carried over to the next one, so no chunk
+    is cut at a block boundary and separators keep their priority. The carry
+    is at most one chunk long."""
+    chunk_size = splitter._chunk_size
+    carry = ""
+    with open(path) as f:
+        while block := f.read(STREAMING_BUFFER_SIZE):
+            text = carry + block
+            chunks = splitter.split_text(text)
+            carry = ""
+            if not chunks:
+                # whitespace, dropped once it is longer than a chunk
+                if len(text) <= chunk_size:
+                    carry = text
+                continue
+            # keep the raw tail, including the separator before the chunk
+            start = text.rfind(chunks[-1])
+            tail = text[start:] if start >= 0 else chunks[-1]
+            if len(tail) <= chunk_size:
+                carry = tail
+                chunks.pop()
+            if chunks:
+                yield chunks
+    if carry:
+        yield splitter.split_text(carry)
+
+
+def _iter_text_documents(
+    content: UploadedFileContent, path: str, splitter: RecursiveCharacterTextSplitter
+) -> Iterator[list[Document]]:
+    for chunks in iter_split_text(path, splitter):
+        yield [
+            Document(page_content=chunk, metadata={"ref_id": str(content.id)})
+            for chunk in chunks
+        ]
+
+
+def _iter_csv_documents(
+    content: UploadedFileContent, path: str
+) -> Iterator[list[Document]]:
+    # rows are formatted like CSVLoader does
+    with open(path, newline="") as f:
+        rows = []
+        for i, row in enumerate(csv.DictReader(f)):
+            page_content = "\n".join(
+                f"{k.strip() if k is not None else k}: "
+                f"{v.strip() if isinstance(v, str) else ','.join(map(str.strip, v)) if isinstance(v, list) else v}"
+                for k, v in row.items()
+            )
+            rows.append(
+                Document(
+                    page_content=page_content,
+                    metadata={"row": i, "ref_id": str(content.id)},
+                )
+            )
+            if len(rows) >= STREAMING_CSV_ROWS:
+                yield standard_text_splitter.split_documents(rows)
+                rows = []
+        if rows:
+            yield standard_text_splitter.split_documents(rows)
+
+
+def open_document_stream(
+    content: UploadedFileContent, path: str
+) -> Iterator[list[Document]] | None:
+    """Returns an iterator over split documents for large text files, None if
+    the file should be loaded with load_documents. Blocking, run it (and the
+    iterator) in a thread."""
+    if os.path.getsize(path) <= STREAMING_THRESHOLD:
+        return None
+    mime_type = content.mime_type or magic.from_file(path, mime=True)
+    if mime_type == "text/csv":
+        return _iter_csv_documents(content, path)
+    splitter = _get_streaming_splitter(mime_type)
+    if splitter is None:
+        return None
+    return _iter_text_documents(content, path, splitter)
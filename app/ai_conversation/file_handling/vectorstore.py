@@ -1,9 +1,19 @@
+import asyncio
+import json
 import os
+from functools import partial
+from hashlib import sha256
 from typing import Iterable, Union
-from uuid import UUID, uuid4
+from uuid import UUID
 from langchain_chroma import Chroma
 import magic
 from app.ai_conversation.entities.uploaded_file_content import UploadedFileContent
+from app.ai_conversation.file_handling.chunk_refs import get_chunk_refs
+from app.ai_conversation.file_handling.file_store import get_file_path
+from app.ai_conversation.file_handling.lexical_index import get_lexical_index
+from app.ai_conversation.file_handling.parsing import get_document_parser
+from app.ai_conversation.file_handling.semantic_splitter import get_semantic_splitter
+from more_itertools import chunked
 from langchain_core.documents import Document
 from langchain_community.document_loaders import (
     TextLoader,
@@ -59,19 +69,58 @@ JSON_SEPARATORS = [
     *TEXT_SEPARATORS[2:],
 ]
 
-# TODO: Add semantic splitter
+# chunks per embedding call and Chroma upsert, capped by Chroma's limit
+WRITE_BATCH_SIZE = int(os.getenv("CHROMA_WRITE_BATCH_SIZE", "256"))
+WRITE_RETRIES = 3
+
+# "recursive" or "semantic", semantic only applies to prose (text, documents)
+TEXT_SPLITTER = os.getenv("TEXT_SPLITTER", "recursive")
+# tokens per semantic chunk, capped by the model's window
+SEMANTIC_MAX_TOKENS = int(os.getenv("SEMANTIC_MAX_TOKENS", "256"))
+SEMANTIC_BREAKPOINT_PERCENTILE = float(
+    os.getenv("SEMANTIC_BREAKPOINT_PERCENTILE", "95")
+)
+
 standard_text_splitter = RecursiveCharacterTextSplitter(
     separators=TEXT_SEPARATORS,
     chunk_size=TEXT_CHUNK_SIZE,
     chunk_overlap=TEXT_CHUNK_OVERLAP,
 )
 
+# stored with every chunk, change it (or the constants above) to re-index
+SPLITTER_VERSION = sha256(
+    json.dumps(
+        [
+            TEXT_SEPARATORS,
+            TEXT_CHUNK_SIZE,
+            TEXT_CHUNK_OVERLAP,
+            CODE_CHUNK_SIZE,
+            CODE_CHUNK_OVERLAP,
+            CSS_SEPARATORS,
+            JSON_SEPARATORS,
+            # only part of the version if used, recursive chunks stay valid
+            *(
+                [TEXT_SPLITTER, SEMANTIC_MAX_TOKENS, SEMANTIC_BREAKPOINT_PERCENTILE]
+                if TEXT_SPLITTER == "semantic"
+                else []
+            ),
+        ]
+    ).encode()
+).hexdigest()[:16]
+
 chroma: Chroma = None
+embedding_model: str = None
 
 
-def set_chroma(chroma_instance: Chroma):
-    global chroma
+def set_chroma(chroma_instance: Chroma, embedding_model_id: str):
+    global chroma, embedding_model
     chroma = chroma_instance
+    embedding_model = embedding_model_id
+
+
+def get_index_version() -> str:
+    global embedding_model
+    return sha256(f"{SPLITTER_VERSION}:{embedding_model}".encode()).hexdigest()[:16]
 
 
 def get_chroma():
@@ -79,7 +128,45 @@ def get_chroma():
     return chroma
 
 
-def _get_splitter_for_language(
+def get_write_batch_size() -> int:
+    global chroma
+    client = chroma._client
+    if hasattr(client, "get_max_batch_size"):
+        return min(WRITE_BATCH_SIZE, client.get_max_batch_size())
+    return WRITE_BATCH_SIZE
+
+
+async def with_retries(func, *args):
+    """Awaits func(*args), retrying with exponential backoff."""
+    for attempt in range(WRITE_RETRIES):
+        try:
+            return await func(*args)
+        except Exception as e:
+            if attempt + 1 >= WRITE_RETRIES:
+                raise
+            print(f"{func.__name__} failed ({e}), retrying")
+            await asyncio.sleep(2**attempt)
+
+
+def get_css_splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        separators=CSS_SEPARATORS,
+        is_separator_regex=True,
+        chunk_size=CODE_CHUNK_SIZE,
+        chunk_overlap=CODE_CHUNK_OVERLAP,
+    )
+
+
+def get_json_splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        separators=JSON_SEPARATORS,
+        is_separator_regex=True,
+        chunk_size=TEXT_CHUNK_SIZE,
+        chunk_overlap=TEXT_CHUNK_OVERLAP,
+    )
+
+
+def get_splitter_for_language(
     language: Language, code: bool = True
 ) -> RecursiveCharacterTextSplitter:
     seperators = RecursiveCharacterTextSplitter.get_separators_for_language(language)
@@ -93,6 +180,17 @@ def _get_splitter_for_language(
     )
 
 
+async def split_prose(
+    docs: list[Document],
+) -> tuple[list[Document], list[list[float]] | None]:
+    """Splits prose, returns the chunks and their embeddings if the splitter
+    already computed them."""
+    splitter = get_semantic_splitter()
+    if splitter is None:
+        return standard_text_splitter.split_documents(docs), None
+    return await splitter.split_documents(docs)
+
+
 def _add_ref(content: UploadedFileContent, docs: Iterable[Document]) -> None:
     for doc in docs:
         del doc.metadata["source"]
@@ -100,17 +198,19 @@ def _add_ref(content: UploadedFileContent, docs: Iterable[Document]) -> None:
 
 
 # https://python.langchain.com/docs/integrations/document_loaders/
-async def import_to_vectorstore(
-    content: UploadedFileContent, custom_path: str = None
-) -> Union[str, bool]:
-    path = (
-        custom_path
-        if custom_path is not None
-        else f"{os.getcwd()}/files/{content.file_ref}"
-    )
-    mime_type = magic.from_file(path, mime=True)
+# CPU heavy loaders (unstructured, pdf) run in worker processes
+async def load_documents(
+    content: UploadedFileContent, path: str
+) -> Union[
+    str, tuple[list[Document], list[Document], list[list[float]] | None]
+]:
+    """Loads and splits a file, returns (loaded, split) documents and the chunk
+    embeddings if already known, or the reason why the file can not be
+    imported."""
+    mime_type = content.mime_type or magic.from_file(path, mime=True)
     docs = []
     before_docs = []
+    embeddings = None
     match mime_type:
         case (
             "audio/aac",
@@ -203,47 +303,32 @@ async def import_to_vectorstore(
             return "Not Allowed"
         case "application/vnd.oasis.opendocument.text":
             # https://python.langchain.com/docs/integrations/document_loaders/odt/
-            before_docs = await UnstructuredODTLoader(path).aload()
+            before_docs = await get_document_parser().parse(UnstructuredODTLoader, path)
             _add_ref(content, before_docs)
-            docs = standard_text_splitter.split_documents(before_docs)
+            docs, embeddings = await split_prose(before_docs)
         case "text/plain":
             before_docs = await TextLoader(path).aload()
             _add_ref(content, before_docs)
-            docs = standard_text_splitter.split_documents(before_docs)
+            docs, embeddings = await split_prose(before_docs)
         case "text/css":
             before_docs = await TextLoader(path).aload()
             _add_ref(content, before_docs)
-            splitter = RecursiveCharacterTextSplitter(
-                separators=CSS_SEPARATORS,
-                is_separator_regex=True,
-                chunk_size=CODE_CHUNK_SIZE,
-                chunk_overlap=CODE_CHUNK_OVERLAP,
-            )
+            splitter = get_css_splitter()
             docs = splitter.split_documents(before_docs)
         case "text/javascript":
             before_docs = await TextLoader(path).aload()
             _add_ref(content, before_docs)
-            splitter = _get_splitter_for_language(Language.JS)
+            splitter = get_splitter_for_language(Language.JS)
             docs = splitter.split_documents(before_docs)
         case "application/json":
             before_docs = await TextLoader(path).aload()
             _add_ref(content, before_docs)
-            splitter = RecursiveCharacterTextSplitter(
-                separators=JSON_SEPARATORS,
-                is_separator_regex=True,
-                chunk_size=TEXT_CHUNK_SIZE,
-                chunk_overlap=TEXT_CHUNK_OVERLAP,
-            )
+            splitter = get_json_splitter()
             docs = splitter.split_documents(before_docs)
         case "application/ld+json":
             before_docs = await TextLoader(path).aload()
             _add_ref(content, before_docs)
-            splitter = RecursiveCharacterTextSplitter(
-                separators=JSON_SEPARATORS,
-                is_separator_regex=True,
-                chunk_size=TEXT_CHUNK_SIZE,
-                chunk_overlap=TEXT_CHUNK_OVERLAP,
-            )
+            splitter = get_json_splitter()
             docs = splitter.split_documents(before_docs)
         case "text/csv":
             # TODO: Better splitter with header? or UnstructuredCSVLoader
@@ -254,89 +339,423 @@ async def import_to_vectorstore(
         case "application/x-latex", "application/x-tex":
             before_docs = await TextLoader(path).aload()
             _add_ref(content, before_docs)
-            splitter = _get_splitter_for_language(Language.LATEX)
+            splitter = get_splitter_for_language(Language.LATEX)
             docs = splitter.split_documents(before_docs)
         case "text/html":
             # https://python.langchain.com/docs/integrations/document_loaders/bshtml/
             before_docs = await BSHTMLLoader(path).aload()
             _add_ref(content, before_docs)
-            docs = standard_text_splitter.split_documents(before_docs)
+            docs, embeddings = await split_prose(before_docs)
         case "application/xhtml+xml", "application/xml", "text/xml":
             # https://python.langchain.com/docs/integrations/document_loaders/xml/
-            before_docs = await UnstructuredXMLLoader(path).aload()
+            before_docs = await get_document_parser().parse(UnstructuredXMLLoader, path)
             _add_ref(content, before_docs)
-            docs = standard_text_splitter.split_documents(before_docs)
+            docs, embeddings = await split_prose(before_docs)
         case (
             "application/msword",
             "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         ):
             # unstructured or normal?
             # https://python.langchain.com/docs/integrations/document_loaders/microsoft_word/#using-unstructured
-            before_docs = await UnstructuredWordDocumentLoader(path).aload()
+            before_docs = await get_document_parser().parse(UnstructuredWordDocumentLoader, path)
             _add_ref(content, before_docs)
-            docs = standard_text_splitter.split_documents(before_docs)
+            docs, embeddings = await split_prose(before_docs)
         case "application/pdf":
             # TODO: Improve with images etc
             # https://python.langchain.com/docs/integrations/document_loaders/#pdfs
-            before_docs = await PyPDFLoader(path).aload()
+            before_docs = await get_document_parser().parse(PyPDFLoader, path)
             _add_ref(content, before_docs)
-            docs = standard_text_splitter.split_documents(before_docs)
+            docs, embeddings = await split_prose(before_docs)
         case "application/x-httpd-php":
             before_docs = await TextLoader(path).aload()
             _add_ref(content, before_docs)
-            splitter = _get_splitter_for_language(Language.PHP)
+            splitter = get_splitter_for_language(Language.PHP)
             docs = splitter.split_documents(before_docs)
         case (
             "application/vnd.ms-powerpoint",
             "application/vnd.openxmlformats-officedocument.presentationml.presentation",
         ):
             # https://python.langchain.com/docs/integrations/document_loaders/microsoft_powerpoint/
-            before_docs = await UnstructuredPowerPointLoader(path).aload()
+            before_docs = await get_document_parser().parse(UnstructuredPowerPointLoader, path)
             _add_ref(content, before_docs)
-            docs = standard_text_splitter.split_documents(before_docs)
+            docs, embeddings = await split_prose(before_docs)
         case (
             "application/vnd.ms-excel",
             "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         ):
             # https://python.langchain.com/docs/integrations/document_loaders/microsoft_excel/
-            before_docs = await UnstructuredExcelLoader(path).aload()
+            before_docs = await get_document_parser().parse(UnstructuredExcelLoader, path)
             _add_ref(content, before_docs)
             docs = standard_text_splitter.split_documents(before_docs)
         case "application/rtf":
-            before_docs = await UnstructuredRTFLoader(path).aload()
+            before_docs = await get_document_parser().parse(UnstructuredRTFLoader, path)
             _add_ref(content, before_docs)
-            docs = standard_text_splitter.split_documents(before_docs)
+            docs, embeddings = await split_prose(before_docs)
         case "application/x-sh", "application/x-csh":
             before_docs = await TextLoader(path).aload()
             _add_ref(content, before_docs)
             docs = standard_text_splitter.split_documents(before_docs)
         case _:
             return "Unknown MIME type: " + mime_type
+    return before_docs, docs, embeddings
+
+
+# chunks are shared between contents, every content referencing a chunk has
+# a "ref:<content id>" key in its metadata, the chunk is deleted with its
+# last reference. ref_id is the content which created the chunk.
+REF_PREFIX = "ref:"
+PAGE_SIZE = 1000
+
+
+def _ref_key(ref_id: UUID | str) -> str:
+    return f"{REF_PREFIX}{ref_id}"
+
+
+def ref_filter(ref_ids: list[UUID | str]) -> dict:
+    """Chroma filter for all chunks referenced by the given contents."""
+    ref_ids = [str(ref_id) for ref_id in ref_ids]
+    # chunks written before chunks were shared only have ref_id
+    return {
+        "$or": [
+            {"ref_id": {"$in": ref_ids}},
+            *[{_ref_key(ref_id): True} for ref_id in ref_ids],
+        ]
+    }
+
+
+def set_visible_ref(docs: list[Document], ref_ids: list[str]) -> None:
+    """Points ref_id of shared chunks to one of the given contents and drops
+    the references, they must not be sent to other users."""
+    for doc in docs:
+        refs = [key for key in doc.metadata if key.startswith(REF_PREFIX)]
+        if doc.metadata.get("ref_id") not in ref_ids:
+            for ref_id in ref_ids:
+                if _ref_key(ref_id) in refs:
+                    doc.metadata["ref_id"] = ref_id
+                    break
+        for key in refs:
+            del doc.metadata[key]
+
+
+def prepare_chunks(docs: list[Document], start: int = 0) -> None:
+    """Sets ids and versions, start is the position of the first document
+    among the chunks of its content."""
+    global embedding_model
+    index_version = get_index_version()
+    for seq, doc in enumerate(docs, start):
+        # position and page, neighbouring chunks are added to retrieved ones
+        doc.metadata["seq"] = seq
+        if "page" not in doc.metadata and "page_number" in doc.metadata:
+            doc.metadata["page"] = doc.metadata["page_number"]
+        # content addressed, equal chunks of different contents share a row
+        doc.metadata["id"] = sha256(
+            f"{index_version}\0{doc.page_content}".encode()
+        ).hexdigest()
+        doc.metadata["splitter"] = SPLITTER_VERSION
+        doc.metadata["embedding_model"] = embedding_model
+        doc.metadata["index_version"] = index_version
+
+
+def _get_existing_ids(ids: list[str]) -> set[str]:
+    global chroma
+    if not ids:
+        return set()
+    return set(chroma._collection.get(ids=ids, include=[])["ids"])
+
+
+async def embed_documents(docs: list[Document]) -> list[list[float]]:
+    global chroma
+    return await chroma.embeddings.aembed_documents([doc.page_content for doc in docs])
+
+
+async def embed_new_documents(docs: list[Document]) -> list[list[float] | None]:
+    """Embeds the documents which are not stored yet, None for the others."""
+    existing = await asyncio.to_thread(
+        _get_existing_ids, list(set(doc.metadata["id"] for doc in docs))
+    )
+    new = {
+        doc.metadata["id"]: doc for doc in docs if doc.metadata["id"] not in existing
+    }
+    embeddings = dict(
+        zip(new, await embed_documents(list(new.values())) if new else [])
+    )
+    return [embeddings.get(doc.metadata["id"]) for doc in docs]
+
+
+def _upsert_documents(
+    docs: list[Document], embeddings: list[list[float] | None]
+) -> list[Document]:
+    global chroma
+    refs: dict[str, set[str]] = {}
+    first: dict[str, tuple[Document, list[float] | None]] = {}
+    for doc, embedding in zip(docs, embeddings):
+        id = doc.metadata["id"]
+        refs.setdefault(id, set()).add(doc.metadata["ref_id"])
+        if id not in first or first[id][1] is None:
+            first[id] = (doc, embedding)
+    existing = _get_existing_ids(list(first))
+    new = [(id, *first[id]) for id in first if id not in existing]
+    # chunks which were deleted since they were looked up
+    missing = [i for i, (_, _, embedding) in enumerate(new) if embedding is None]
+    if missing:
+        vectors = chroma.embeddings.embed_documents(
+            [new[i][1].page_content for i in missing]
+        )
+        for i, vector in zip(missing, vectors):
+            new[i] = (new[i][0], new[i][1], vector)
+    if new:
+        chroma._collection.upsert(
+            ids=[id for id, _, _ in new],
+            embeddings=[embedding for _, _, embedding in new],
+            metadatas=[
+                {**doc.metadata, **{_ref_key(ref): True for ref in refs[id]}}
+                for id, doc, _ in new
+            ],
+            documents=[doc.page_content for _, doc, _ in new],
+        )
+    shared = [id for id in first if id in existing]
+    if shared:
+        # metadata updates are merged, this only adds the references
+        chroma._collection.update(
+            ids=shared,
+            metadatas=[{_ref_key(ref): True for ref in refs[id]} for id in shared],
+        )
+    return docs
+
+
+async def upsert_documents(
+    docs: list[Document], embeddings: list[list[float] | None]
+) -> None:
+    """Writes already embedded documents, None embeddings are chunks which are
+    already stored and only get a reference. Ids are fixed, so retrying is
+    safe."""
+    await get_chunk_refs().add(docs, partial(_upsert_documents, embeddings=embeddings))
+
+
+async def write_documents(
+    docs: list[Document], embeddings: list[list[float]] = None
+) -> None:
+    batch_size = get_write_batch_size()
+    for i in range(0, len(docs), batch_size):
+        batch = docs[i : i + batch_size]
+        if embeddings is not None:
+            batch_embeddings = embeddings[i : i + batch_size]
+        else:
+            batch_embeddings = await with_retries(embed_new_documents, batch)
+        await with_retries(upsert_documents, batch, batch_embeddings)
+
+
+def get_chunk_ids(ref_id: UUID) -> list[str]:
+    global chroma
+    return chroma.get(where=ref_filter([ref_id]), include=[])["ids"]
+
+
+def _to_documents(result: dict) -> list[Document]:
+    return [
+        Document(page_content=document, metadata={**metadata, "id": id})
+        for id, document, metadata in zip(
+            result["ids"], result["documents"], result["metadatas"]
+        )
+    ]
+
+
+def _get_documents_by_ids(ids: list[str]) -> tuple[list[Document], list]:
+    global chroma
+    result = chroma._collection.get(
+        ids=ids, include=["documents", "metadatas", "embeddings"]
+    )
+    return _to_documents(result), list(result["embeddings"])
+
+
+async def get_documents_by_ids(ids: list[str]) -> tuple[list[Document], list]:
+    """Returns the stored chunks and their embeddings."""
+    if not ids:
+        return [], []
+    return await asyncio.to_thread(_get_documents_by_ids, ids)
+
+
+def _similarity_search(
+    embedding: list[float], ref_ids: list[str], k: int
+) -> tuple[list[Document], list[float], list]:
+    global chroma
+    result = chroma._collection.query(
+        query_embeddings=[embedding],
+        n_results=k,
+        where=ref_filter(ref_ids),
+        include=["documents", "metadatas", "distances", "embeddings"],
+    )
+    result = {
+        key: result[key][0]
+        for key in ["ids", "documents", "metadatas", "distances", "embeddings"]
+    }
+    # cosine space, same relevance score as the langchain retriever
+    scores = [1 - distance for distance in result["distances"]]
+    return _to_documents(result), scores, list(result["embeddings"])
+
+
+async def similarity_search(
+    embedding: list[float], ref_ids: list[str], k: int
+) -> tuple[list[Document], list[float], list]:
+    """Returns the k nearest chunks of the contents, their relevance scores
+    and their embeddings."""
+    return await asyncio.to_thread(_similarity_search, embedding, ref_ids, k)
+
+
+def _get_chunks(ids: list[str]) -> list[Document]:
+    global chroma
+    return _to_documents(
+        chroma._collection.get(ids=ids, include=["documents", "metadatas"])
+    )
+
+
+async def get_chunks(ids: list[str]) -> list[Document]:
+    """Returns the stored chunks, without their embeddings."""
+    if not ids:
+        return []
+    return await asyncio.to_thread(_get_chunks, ids)
+
+
+def _get_chunk_page(ref_id: UUID, offset: int) -> list[Document]:
+    global chroma
+    docs = _to_documents(
+        chroma._collection.get(
+            where=ref_filter([ref_id]),
+            include=["documents", "metadatas"],
+            limit=PAGE_SIZE,
+            offset=offset,
+        )
+    )
+    for doc in docs:
+        # the position belongs to the content which created the chunk
+        if doc.metadata.get("ref_id") != str(ref_id):
+            doc.metadata.pop("seq", None)
+        doc.metadata["ref_id"] = str(ref_id)
+    return docs
+
+
+def _get_referenced(ref_id: str, docs: list[Document]) -> list[Document]:
+    global chroma
+    result = chroma._collection.get(
+        ids=[doc.metadata["id"] for doc in docs], include=["metadatas"]
+    )
+    referenced = {
+        id
+        for id, metadata in zip(result["ids"], result["metadatas"])
+        if metadata.get(_ref_key(ref_id)) or metadata.get("ref_id") == ref_id
+    }
+    return [doc for doc in docs if doc.metadata["id"] in referenced]
+
+
+async def index_lexical(ref_id: UUID) -> None:
+    """Adds the stored chunks of a content to the lexical index, with the
+    references and positions of chunks written before they were kept in
+    Postgres."""
+    offset = 0
+    while docs := await asyncio.to_thread(_get_chunk_page, ref_id, offset):
+        # released since the page was read
+        await get_chunk_refs().add(docs, partial(_get_referenced, str(ref_id)))
+        if len(docs) < PAGE_SIZE:
+            break
+        offset += PAGE_SIZE
+    # references which existed before their chunk was indexed
+    await get_lexical_index().recount(ref_id)
+
+
+def _release_page(ref_ids: list[str], remaining: dict[str, list[str]]) -> list[str]:
+    global chroma
+    result = chroma._collection.get(ids=list(remaining), include=["metadatas"])
+    stored = dict(zip(result["ids"], result["metadatas"]))
+    to_delete = []
+    to_update = []
+    updates = []
+    for id, refs in remaining.items():
+        metadata = stored.get(id, {})
+        # chunks written before the references were kept in Postgres only
+        # have keys (or ref_id)
+        refs = refs + [
+            key[len(REF_PREFIX) :]
+            for key in metadata
+            if key.startswith(REF_PREFIX)
+            and key[len(REF_PREFIX) :] not in ref_ids
+            and key[len(REF_PREFIX) :] not in refs
+        ]
+        if not refs:
+            to_delete.append(id)
+            continue
+        if id not in stored:
+            continue
+        # None removes the key
+        update = {
+            _ref_key(ref_id): None for ref_id in ref_ids if _ref_key(ref_id) in metadata
+        }
+        if metadata.get("ref_id") in ref_ids:
+            # the position was the one in the released content
+            update["ref_id"] = refs[0]
+            update["seq"] = None
+        if update:
+            to_update.append(id)
+            updates.append(update)
+    if to_delete:
+        chroma._collection.delete(ids=to_delete)
+    if to_update:
+        chroma._collection.update(ids=to_update, metadatas=updates)
+    return to_delete
+
+
+def _get_ref_page(ref_ids: list[str]) -> list[str]:
+    global chroma
+    return chroma._collection.get(
+        where=ref_filter(ref_ids), include=[], limit=PAGE_SIZE
+    )["ids"]
+
+
+async def release_chunks(ref_ids: list[UUID], ids: list[str] = None) -> None:
+    """Removes the references of the contents from their chunks (or only from
+    the given chunks), chunks without references are deleted."""
+    ref_ids = [str(ref_id) for ref_id in ref_ids]
+    if len(ref_ids) < 1 or (ids is not None and len(ids) < 1):
+        return
+    release = partial(_release_page, ref_ids)
+    if ids is not None:
+        for batch in chunked(ids, PAGE_SIZE):
+            await get_chunk_refs().release(ref_ids, list(batch), release)
+        return
+    previous = None
+    while True:
+        # released chunks do not match anymore, so the first page is fetched
+        # again. Chunks written before the references were kept in Postgres
+        # are only found in Chroma.
+        page = sorted(
+            set(await asyncio.to_thread(_get_ref_page, ref_ids))
+            | set(await get_chunk_refs().get_chunk_ids(ref_ids, PAGE_SIZE))
+        )
+        if not page or page == previous:
+            break
+        await get_chunk_refs().release(ref_ids, page, release)
+        previous = page
+
+
+async def import_to_vectorstore(
+    content: UploadedFileContent, custom_path: str = None
+) -> Union[str, bool]:
+    path = (
+        custom_path
+        if custom_path is not None
+        else get_file_path(content.file_ref)
+    )
+    loaded = await load_documents(content, path)
+    if isinstance(loaded, str):
+        return loaded
+    before_docs, docs, embeddings = loaded
     if docs:
-        global chroma
-        for doc in docs:
-            doc.metadata["id"] = str(uuid4())
+        prepare_chunks(docs)
         if custom_path is not None:
             print(f"Inserting {len(docs)} documents for {content.id} with custom path")
-        await chroma.aadd_documents(docs, ids=[doc.metadata["id"] for doc in docs])
+        await write_documents(docs, embeddings)
         if custom_path is not None:
             return before_docs
     return True
 
 
 async def on_content_deleted(ref_ids: list[UUID]):
-    if len(ref_ids) < 1:
-        return
-    PAGE_SIZE = 1000
-    has_remaining_elements = True
-    global chroma
-    while has_remaining_elements:
-        result = chroma.get(
-            where={"ref_id": {"$in": list(map(lambda x: str(x), ref_ids))}},
-            include=[],
-            limit=PAGE_SIZE,
-        )
-        ids = result["ids"]
-        has_remaining_elements = len(ids) >= PAGE_SIZE
-        if len(ids) > 0:
-            await chroma.adelete(ids)
+    await release_chunks(ref_ids)
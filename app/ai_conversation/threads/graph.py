@@ -1,3 +1,5 @@
+import asyncio
+import traceback
 from typing import Any, List
 from uuid import UUID
 from fastapi import HTTPException
@@ -22,13 +24,19 @@ from app.ai_conversation.ai_conversation import (
 from app.ai_conversation.assistants.models import WrappedAssistant
 from app.ai_conversation.assistants.service import get_generic_assistant
 from app.ai_conversation.entities.thread import Thread
-from app.ai_conversation.file_handling.vectorstore import get_chroma
+from app.ai_conversation.file_handling.retrieval import retrieve
+from app.ai_conversation.file_handling.vectorstore import set_visible_ref
 from langchain_core.runnables import RunnableConfig
+from app.ai_conversation.threads.retrieval_context import (
+    RetrievalContext,
+    get_retrieval_context_cache,
+)
 from app.ai_conversation.threads.service import (
     create_thread,
     delete_thread,
     list_threads,
     get_thread,
+    rename_thread,
 )
 from app.routes.utils import select_model
 from langserve.serialization import WellKnownLCSerializer
@@ -36,6 +44,14 @@ from app.ai_conversation.threads.chat_namer import chain as chat_namer_chain
 import json
 import datetime
 
+# thread names are limited to 255 characters
+THREAD_NAME_LENGTH = 255
+# shown until the generated title arrives
+PROVISIONAL_NAME_LENGTH = 60
+# the end event is held back at most this long for the generated title,
+# the provisional name is kept if it takes longer
+NAMING_TIMEOUT_SECONDS = 3
+
 rag_template = SystemMessagePromptTemplate.from_template(
     """You are an assistant for question-answering tasks. Use the following pieces of retrieved context and the role below to answer the question.
 Always add citations whenever possible in the form of †[document_id]† at the end of a paragraph, inside the text, or at the end of the answer.
@@ -81,45 +97,52 @@ def _message_to_str(message: HumanMessage):
     return text
 
 
-async def _make_content_filter(state: GraphState, config: RunnableConfig):
+async def _get_retrieval_context(
+    state: GraphState, config: RunnableConfig
+) -> RetrievalContext:
     assistant: WrappedAssistant = config["configurable"]["assistant"]
-    ids = set([str(f.content_id) for _, f in assistant.files])
+    account_id = config["configurable"]["user_info"]["id"]
+    thread_id = config["configurable"].get("thread_id")
+    assistant_ids = frozenset(str(f.content_id) for _, f in assistant.files)
     messages: list[BaseMessage] = state["messages"]
-    message_ids = set(
-        [e for m in messages for e in m.additional_kwargs.get("attachments", [])]
+    message_ids = frozenset(
+        e for m in messages for e in m.additional_kwargs.get("attachments", [])
     )
-    # files to content ids
+    key = (assistant_ids, message_ids)
+    cache = get_retrieval_context_cache()
+    context = cache.get(thread_id, account_id, key) if thread_id else None
+    if context is not None:
+        return context
+    # attachments to content ids, names of the user's files for all contents
     async with get_connection_pool().acquire() as conn:
         rows = await conn.fetch(
-            """SELECT content_id
+            """SELECT id, content_id, name
                FROM uploaded_file
-               WHERE account_id = $1 AND id IN (SELECT unnest($2::uuid[]));""",
-            config["configurable"]["user_info"]["id"],
+               WHERE account_id = $1
+                 AND (id IN (SELECT unnest($2::uuid[]))
+                   OR content_id IN (SELECT unnest($3::uuid[])));""",
+            account_id,
             list(message_ids),
+            list(assistant_ids),
         )
+    ids = set(assistant_ids)
+    names = {}
     for row in rows:
-        ids.add(str(row["content_id"]))
-    if len(ids) < 1:
-        return None
-    return {
-        "ref_id": {"$in": list(ids)},
-    }
+        content_id = str(row["content_id"])
+        if str(row["id"]) in message_ids:
+            ids.add(content_id)
+        names[content_id] = row["name"]
+    context = RetrievalContext(account_id, key, list(ids), names)
+    if thread_id:
+        cache.put(thread_id, context)
+    return context
 
 
-async def _apply_file_names(documents: list[Document], account_id: UUID):
-    async with get_connection_pool().acquire() as conn:
-        rows = await conn.fetch(
-            """SELECT content_id, name
-               FROM uploaded_file
-               WHERE account_id = $1 AND content_id IN (SELECT unnest($2::uuid[]));""",
-            account_id,
-            list(set(d.metadata["ref_id"] for d in documents)),
-        )
-
-    for row in rows:
-        content_id = str(row["content_id"])
-        for e in filter(lambda x: x.metadata["ref_id"] == content_id, documents):
-            e.metadata["name"] = row["name"]
+def _apply_file_names(documents: list[Document], names: dict[str, str]):
+    for document in documents:
+        name = names.get(document.metadata["ref_id"])
+        if name is not None:
+            document.metadata["name"] = name
 
 
 async def _rag_for_last_message(state: GraphState, config: RunnableConfig):
@@ -127,26 +150,15 @@ async def _rag_for_last_message(state: GraphState, config: RunnableConfig):
     input = messages[-1]
     if input.type != "human":
         raise ValueError("Last message must be human")
-    content_filter = await _make_content_filter(state, config)
-    if content_filter:
-        documents = (
-            await get_chroma()
-            .as_retriever(
-                search_type="similarity_score_threshold",
-                search_kwargs={
-                    "score_threshold": 0.4,
-                    "k": 7,
-                    "filter": content_filter,
-                },
-            )
-            .ainvoke(_message_to_str(input))
-        )
-    else:
-        documents = []
+    context = await _get_retrieval_context(state, config)
+    content_ids = context.content_ids
+    documents = await retrieve(_message_to_str(input), content_ids)
     if len(documents) < 1:
         return {"messages": []}
+    # shared chunks may have been created by a content the user can not see
+    set_visible_ref(documents, content_ids)
     # add names as metadata
-    await _apply_file_names(documents, config["configurable"]["user_info"]["id"])
+    _apply_file_names(documents, context.names)
     message = ToolMessage(
         content="", artifact={"documents": documents}, tool_call_id="rag"
     )
@@ -226,6 +238,7 @@ class GraphWrapper:
         room_id = configurable["room"]["id"]
         user_id = configurable["user_info"]["id"]
         await delete_thread(thread_id, room_id, user_id)
+        get_retrieval_context_cache().invalidate_thread(str(thread_id))
 
     async def new_chat(
         self, config: RunnableConfig, input: HumanMessage, assistant_id: UUID
@@ -234,26 +247,50 @@ class GraphWrapper:
         room_id = configurable["room"]["id"]
         user_id = configurable["user_info"]["id"]
         input = self._strip_information(input)
-        assistant = await get_generic_assistant(config, assistant_id)
-        if not assistant:
-            raise HTTPException(
-                status_code=404,
-                detail="Assistant not found",
+        # the title is generated while the answer streams, it is sent as a
+        # thread_updated event
+        naming = asyncio.create_task(
+            chat_namer_chain.ainvoke(
+                {"messages": [input]},
+                {**config, "configurable": dict(configurable)},
             )
-        configurable["assistant"] = assistant
-        name = await chat_namer_chain.ainvoke({"messages": [input]}, config)
-        thread = await create_thread(
-            room_id,
-            user_id,
-            name,
         )
-        yield {
-            "data": json.dumps(thread.__dict__, cls=Encoding),
-            "event": "thread_created",
-        }
-        config["configurable"]["thread_id"] = str(thread.id)
-        async for event in self._call_graph({"messages": input}, config):
-            yield event
+        try:
+            assistant, thread = await asyncio.gather(
+                get_generic_assistant(config, assistant_id),
+                create_thread(room_id, user_id, self._provisional_name(input)),
+                return_exceptions=True,
+            )
+            if isinstance(thread, BaseException):
+                raise thread
+            if isinstance(assistant, BaseException) or not assistant:
+                # the thread is only kept if the chat can start
+                await delete_thread(thread.id, room_id, user_id)
+                if isinstance(assistant, BaseException):
+                    raise assistant
+                raise HTTPException(
+                    status_code=404,
+                    detail="Assistant not found",
+                )
+            configurable["assistant"] = assistant
+            yield {
+                "data": json.dumps(thread.__dict__, cls=Encoding),
+                "event": "thread_created",
+            }
+            config["configurable"]["thread_id"] = str(thread.id)
+            named = False
+            async for event in self._call_graph({"messages": input}, config):
+                if event["event"] == "end":
+                    # clients stop listening after the end event
+                    await asyncio.wait([naming], timeout=NAMING_TIMEOUT_SECONDS)
+                if not named and naming.done():
+                    named = True
+                    renamed = await self._apply_name(thread, naming)
+                    if renamed:
+                        yield renamed
+                yield event
+        finally:
+            naming.cancel()
 
     async def continue_chat(
         self,
@@ -266,22 +303,22 @@ class GraphWrapper:
         room_id = configurable["room"]["id"]
         user_id = configurable["user_info"]["id"]
         input = self._strip_information(input)
-        assistant = await get_generic_assistant(config, assistant_id)
+        assistant, thread = await asyncio.gather(
+            get_generic_assistant(config, assistant_id),
+            get_thread(thread_id, room_id, user_id),
+        )
         if not assistant:
             raise HTTPException(
                 status_code=404,
                 detail="Assistant not found",
             )
         configurable["assistant"] = assistant
-        thread = await get_thread(thread_id, room_id, user_id)
         if not thread:
             raise HTTPException(
                 status_code=404,
                 detail="Thread not found",
             )
         config["configurable"]["thread_id"] = str(thread.id)
-        state = await self.graph.aget_state(config)
-        print(state.next)
         # assert message and state
         async for event in self._call_graph({"messages": [input]}, config):
             yield event
@@ -317,6 +354,29 @@ class GraphWrapper:
                 }
         yield {"event": "end"}
 
+    def _provisional_name(self, message: HumanMessage) -> str:
+        text = " ".join(_message_to_str(message).split())
+        if len(text) > PROVISIONAL_NAME_LENGTH:
+            text = text[: PROVISIONAL_NAME_LENGTH - 1] + "…"
+        return text or "New chat"
+
+    async def _apply_name(self, thread: Thread, naming: asyncio.Task) -> dict | None:
+        try:
+            name = naming.result().strip()[:THREAD_NAME_LENGTH]
+        except Exception:
+            # the provisional name stays
+            print(traceback.format_exc())
+            return None
+        if not name:
+            return None
+        thread = await rename_thread(thread.id, name)
+        if not thread:
+            return None
+        return {
+            "data": json.dumps(thread.__dict__, cls=Encoding),
+            "event": "thread_updated",
+        }
+
     def _strip_information(self, message: HumanMessage):
         if not message:
             return None
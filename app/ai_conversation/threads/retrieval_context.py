@@ -0,0 +1,78 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from uuid import UUID
+
+# entries are dropped when files change on this instance, the ttl bounds how
+# long a file deleted on another instance stays searchable
+RETRIEVAL_CONTEXT_TTL_SECONDS = float(os.getenv("RETRIEVAL_CONTEXT_TTL_SECONDS", "300"))
+RETRIEVAL_CONTEXT_CACHE_SIZE = int(os.getenv("RETRIEVAL_CONTEXT_CACHE_SIZE", "10000"))
+
+
+@dataclass
+class RetrievalContext:
+    account_id: UUID
+    # assistant content ids and message attachment ids it was resolved from
+    key: tuple[frozenset, frozenset]
+    content_ids: list[str]
+    # content id -> file name of the user
+    names: dict[str, str] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class RetrievalContextCache:
+    """Resolved content ids and file names per thread, so follow-up questions
+    do not query uploaded_file again.
+
+    An entry is used while the assistant files and attachments of the thread
+    are unchanged. Deleting a file drops the entries of its account.
+    """
+
+    def __init__(
+        self,
+        max_size: int = RETRIEVAL_CONTEXT_CACHE_SIZE,
+        ttl: float = RETRIEVAL_CONTEXT_TTL_SECONDS,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, RetrievalContext] = OrderedDict()
+
+    def get(
+        self, thread_id: str, account_id: UUID, key: tuple[frozenset, frozenset]
+    ) -> RetrievalContext | None:
+        context = self.entries.get(thread_id)
+        if context is None:
+            return None
+        if (
+            str(context.account_id) != str(account_id)
+            or context.key != key
+            or time.monotonic() - context.created_at > self.ttl
+        ):
+            del self.entries[thread_id]
+            return None
+        self.entries.move_to_end(thread_id)
+        return context
+
+    def put(self, thread_id: str, context: RetrievalContext) -> None:
+        self.entries[thread_id] = context
+        self.entries.move_to_end(thread_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate_thread(self, thread_id: str) -> None:
+        self.entries.pop(thread_id, None)
+
+    def invalidate_account(self, account_id: UUID) -> None:
+        for thread_id in [
+            k for k, v in self.entries.items() if str(v.account_id) == str(account_id)
+        ]:
+            del self.entries[thread_id]
+
+
+retrieval_context_cache = RetrievalContextCache()
+
+
+def get_retrieval_context_cache() -> RetrievalContextCache:
+    global retrieval_context_cache
+    return retrieval_context_cache
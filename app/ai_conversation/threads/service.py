@@ -26,6 +26,16 @@ async def create_thread(room_id: UUID, account_id: UUID, name: str) -> Thread:
         return Thread.load_from_db(thread)
 
 
+async def rename_thread(thread_id: UUID, name: str) -> Thread | None:
+    async with get_connection_pool().acquire() as conn:
+        thread = await conn.fetchrow(
+            "UPDATE thread SET name = $1 WHERE id = $2 RETURNING *;",
+            name,
+            thread_id,
+        )
+        return Thread.load_from_db(thread) if thread else None
+
+
 async def get_thread(thread_id: UUID, room_id: UUID | None, account_id: UUID) -> Thread:
     async with get_connection_pool().acquire() as conn:
         if room_id is None:
@@ -1,13 +1,16 @@
 import asyncio
+import os
 
-from langchain_huggingface import HuggingFaceEmbeddings
 from app.ai_conversation.ai_conversation import MODEL_NAME
+from app.ai_conversation.embeddings.backends import load_embedding_backend
 from app.routes.moderate import run_moderate
 from app.routes.category_list import extract_keywords
 
 
 async def main():
-    embeddings = HuggingFaceEmbeddings(model_name=MODEL_NAME)
+    embeddings, _ = load_embedding_backend(
+        MODEL_NAME, os.getenv("EMBEDDING_BACKEND", "torch")
+    )
     await embeddings.aembed_query("Hello, world!")
     run_moderate(["Test"], None)
     try:
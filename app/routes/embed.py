@@ -1,8 +1,12 @@
+import asyncio
+from typing import Literal, Optional
 from app.ai_conversation.ai_conversation import get_embedding_function
-from fastapi import APIRouter, Body
+from fastapi import APIRouter, Body, Header, HTTPException, Response
 import base64
+import struct
 import numpy as np
 
+from app.routes.similarity import duplicate_clusters, top_k_neighbors
 from app.security.oauth2 import DEPENDENCIES
 
 
@@ -15,11 +19,68 @@ def to_b64(vec: list[float]) -> str:
     return base64.b64encode(vec).decode("utf-8")
 
 
+BINARY_MEDIA_TYPE = "application/octet-stream"
+JSON_MEDIA_TYPE = "application/json"
+
+
+def _quality(ranges: list[tuple[str, float]], media_type: str) -> float:
+    # the most specific matching range decides
+    main_type = media_type.split("/")[0]
+    for candidates in ([media_type], [f"{main_type}/*"], ["*/*"]):
+        matches = [q for media_range, q in ranges if media_range in candidates]
+        if matches:
+            return max(matches)
+    return 0.0
+
+
+def prefers_binary(accept: str) -> bool:
+    """True if the Accept header ranks the binary format above JSON, JSON is
+    returned on ties."""
+    ranges = []
+    for part in accept.split(","):
+        media_range, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_range:
+            ranges.append((media_range.lower(), q))
+    binary = _quality(ranges, BINARY_MEDIA_TYPE)
+    return binary > 0 and binary > _quality(ranges, JSON_MEDIA_TYPE)
+
+
+def to_binary(vectors: np.ndarray, dtype: str) -> bytes:
+    # header: little endian uint32 count, uint32 dimension
+    header = struct.pack("<II", *vectors.shape)
+    if vectors.shape[0] == 0:
+        # no rows and no scales, max() has nothing to reduce
+        return header
+    match dtype:
+        case "float16":
+            return header + vectors.astype(np.float16).tobytes()
+        case "int8":
+            # symmetric per vector quantization, scales precede the rows
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            quantized = np.rint(vectors / scales[:, None]).astype(np.int8)
+            return header + scales.astype(np.float32).tobytes() + quantized.tobytes()
+        case _:
+            return header + vectors.astype(np.float32, copy=False).tobytes()
+
+
 router = APIRouter()
 
 
 @router.post("/embed", dependencies=DEPENDENCIES, tags=["Similarity Embedding"])
-async def embed_texts(texts: list[str] = Body(..., embed=True)) -> list[str]:
+async def embed_texts(
+    texts: list[str] = Body(..., embed=True),
+    dtype: Literal["float32", "float16", "int8"] = "float32",
+    accept: str = Header("application/json"),
+) -> list[str]:
     """
     You can convert base64 string to Float32Array with the following code:
     
@@ -28,6 +89,87 @@ async def embed_texts(texts: list[str] = Body(..., embed=True)) -> list[str]:
     byte_array = Uint8Array.from(atob(base64), c => c.charCodeAt(0))
     vectors = new Float32Array(byte_array.buffer)
     </code></pre>
+
+    With `Accept: application/octet-stream` all vectors are returned in one buffer instead.
+    It starts with two little endian uint32 (count, dimension), followed by the rows in the requested `dtype`.
+    For `int8`, the rows are preceded by one float32 scale per vector (value = int8 * scale).
+
+    <pre><code>
+    view = new DataView(buffer)
+    count = view.getUint32(0, true)
+    dimension = view.getUint32(4, true)
+    vectors = new Float32Array(buffer, 8, count * dimension)
+    </code></pre>
     """
     vectors = await transform_standard_retrieve(texts)
-    return [to_b64(v) for v in vectors]
+    if not prefers_binary(accept):
+        return [to_b64(v) for v in vectors]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2:
+        # no texts given
+        vectors = vectors.reshape(0, 0)
+    return Response(
+        content=to_binary(vectors, dtype),
+        media_type=BINARY_MEDIA_TYPE,
+        headers={"X-Embedding-Dtype": dtype},
+    )
+
+
+async def _embed_labeled(texts: list[str], ids: Optional[list[str]]):
+    if ids is None:
+        ids = list(range(len(texts)))
+    elif len(ids) != len(texts):
+        raise HTTPException(status_code=400, detail="ids and texts differ in length")
+    # repeated requests for the same room are answered from the embedding cache
+    vectors = await transform_standard_retrieve(texts)
+    return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1), ids
+
+
+@router.post("/neighbors", dependencies=DEPENDENCIES, tags=["Similarity Embedding"])
+async def find_neighbors(
+    texts: list[str] = Body(..., embed=True),
+    ids: Optional[list[str]] = Body(None, embed=True),
+    k: int = 5,
+    min_score: float = 0.0,
+) -> list[dict]:
+    """
+    Returns the k most similar texts for every text (cosine similarity).
+    `ids` are optional labels for the texts, the index is used otherwise.
+    """
+    if not texts:
+        return []
+    vectors, ids = await _embed_labeled(texts, ids)
+    indices, scores = await asyncio.to_thread(top_k_neighbors, vectors, k)
+    return [
+        {
+            "id": ids[i],
+            "neighbors": [
+                {"id": ids[j], "score": float(score)}
+                for j, score in zip(indices[i], scores[i])
+                if score >= min_score
+            ],
+        }
+        for i in range(len(ids))
+    ]
+
+
+@router.post("/duplicates", dependencies=DEPENDENCIES, tags=["Similarity Embedding"])
+async def find_duplicates(
+    texts: list[str] = Body(..., embed=True),
+    ids: Optional[list[str]] = Body(None, embed=True),
+    threshold: float = 0.9,
+) -> list[list]:
+    """
+    Groups texts with a cosine similarity of at least `threshold` into clusters.
+    Texts without duplicates are not returned.
+    """
+    if not texts:
+        return []
+    vectors, ids = await _embed_labeled(texts, ids)
+    clusters = await asyncio.to_thread(duplicate_clusters, vectors, threshold)
+    return [[ids[i] for i in cluster] for cluster in clusters]
+
+
+@router.get("/cache-stats", dependencies=DEPENDENCIES, tags=["Similarity Embedding"])
+async def embedding_cache_stats() -> dict:
+    return get_embedding_function().stats()
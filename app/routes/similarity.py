@@ -0,0 +1,87 @@
+import os
+import numpy as np
+
+# above this many vectors an HNSW index is used instead of exact search
+ANN_THRESHOLD = int(os.getenv("SIMILARITY_ANN_THRESHOLD", "5000"))
+# rows per matrix product, bounds memory to BLOCK_SIZE * n floats
+BLOCK_SIZE = 1024
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _exact_top_k(vectors: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    n = vectors.shape[0]
+    indices = np.empty((n, k), dtype=np.int64)
+    scores = np.empty((n, k), dtype=np.float32)
+    for start in range(0, n, BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, n)
+        block = vectors[start:end] @ vectors.T
+        # never return the vector itself
+        block[np.arange(end - start), np.arange(start, end)] = -np.inf
+        part = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        part_scores = np.take_along_axis(block, part, axis=1)
+        order = np.argsort(-part_scores, axis=1)
+        indices[start:end] = np.take_along_axis(part, order, axis=1)
+        scores[start:end] = np.take_along_axis(part_scores, order, axis=1)
+    return indices, scores
+
+
+def _ann_top_k(vectors: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    import hnswlib
+
+    n, dimension = vectors.shape
+    index = hnswlib.Index(space="cosine", dim=dimension)
+    index.init_index(max_elements=n, ef_construction=100, M=16)
+    index.add_items(vectors, np.arange(n))
+    index.set_ef(max(50, k + 1))
+    labels, distances = index.knn_query(vectors, k=k + 1)
+    indices = np.empty((n, k), dtype=np.int64)
+    scores = np.empty((n, k), dtype=np.float32)
+    for i in range(n):
+        # drop the vector itself (normally the first hit)
+        keep = labels[i] != i
+        indices[i] = labels[i][keep][:k]
+        scores[i] = 1 - distances[i][keep][:k]
+    return indices, scores
+
+
+def top_k_neighbors(
+    vectors: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns indices and cosine similarities of the k nearest neighbors of
+    every vector, sorted by descending similarity."""
+    n = vectors.shape[0]
+    k = min(k, n - 1)
+    if k < 1:
+        return np.empty((n, 0), dtype=np.int64), np.empty((n, 0), dtype=np.float32)
+    vectors = normalize(np.asarray(vectors, dtype=np.float32))
+    if n > ANN_THRESHOLD:
+        return _ann_top_k(vectors, k)
+    return _exact_top_k(vectors, k)
+
+
+def duplicate_clusters(
+    vectors: np.ndarray, threshold: float, max_neighbors: int = 10
+) -> list[list[int]]:
+    """Groups vectors whose cosine similarity is at least threshold."""
+    indices, scores = top_k_neighbors(vectors, max_neighbors)
+    parent = list(range(vectors.shape[0]))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(*np.nonzero(scores >= threshold)):
+        a, b = find(int(i)), find(int(indices[i, j]))
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    clusters: dict[int, list[int]] = {}
+    for i in range(len(parent)):
+        clusters.setdefault(find(i), []).append(i)
+    return [c for c in clusters.values() if len(c) > 1]